@@ -1,15 +1,31 @@
 import os
+import re
+import itertools
 import json
 import copy
-import pyxel
-import pyxel.core as core
+import mmap
+import ctypes
+import struct
+import hashlib
+import threading
+import time
+import wave
 import lcl
 import dataclasses
+from array import array
 from dataclasses import *
 from typing import MutableSequence
 from typing import Any, Callable, Dict, List, Optional
 from logging import debug, info, warning, error
 
+# without pyxel lcl runs on the headless backend (see use_backend())
+try:
+    import pyxel
+    import pyxel.core as core
+except ImportError:
+    pyxel = None
+    core = None
+
 NOTEKEY_NAME_LIST = ["C","C#","D","D#","E","F","F#","G","G#","A","A#","B"]
 DOREMI_NAME_LIST = ["Do", "Do#","Re","Re#", "Mi", "Fa","Fa#", "So","So#", "Ra","Ra#", "Si"]
 TONE_NAME_LIST = ["T","S","P","N"]
@@ -28,9 +44,26 @@ loaded_lcmusic_index = None
 loaded_channels = None
 loaded_pages = None
 loaded_to_tail = None
+loaded_sound_base = None    # first sound index of the loaded lcmusic (see sound_bank)
+loaded_sound_key = None
+loaded_sound_table = None   # sound index of each bar: loaded_sound_table[ch][bar]
+loaded_dedupe = False
+preloads = {}               # load key -> _Preload, see preload()
+load_jobs = []              # running LoadJobs of begin_load(), their blocks are evicted last
+sfx_table = {}              # sfx name -> sound index, see register_sfx()
+sfx_lengths = {}            # sfx name -> seconds
+sfx_strs = {}               # sfx name -> format string
 music_play_start_bar = None
 used_sound_list = []
+loaded_sound_versions = {}  # sound index -> (LCSound version, speed) last uploaded
 played_page_loop_setting = False
+played_music_id = 7
+played_loop = False
+played_start_bar = 0
+music_stream = None         # _MusicStream of play_stream(), fed by update()
+music_queue = None          # _QueuedMusic of queue()
+played_bars = []            # bar of each entry of the ch0 play list of the music
+music_loop_switch = None    # (music id, play list index of the first loop repeat, loop play list) watched by update()
 
 # Lovely Composer Data Class -------------------------
 
@@ -147,21 +180,92 @@ class LCRhythmList(MutableSequence):
         return len(self.rhythms)
 
 
-@dataclass
 class LCVoice:
-    n: int = None#dataclasses.field(default=None) note
-    t: int = 0#field(default=0) tone
-    v: int = 5#dataclasses.field(default=5) volume
-    f: int = 0#dataclasses.field(default=0) effect
-    id: int = None
+    # One tick of a sound.
+    # A voice taken from an LCSound is a view: it reads and writes the
+    # packed arrays of that sound. A voice made with LCVoice() keeps its own values.
+
+    def __init__(self, n=None, t=0, v=5, f=0, id=None):
+        self._snd = None
+        self._tick = 0
+        self._n = n     # note
+        self._t = t     # tone
+        self._v = v     # volume
+        self._f = f     # effect
+        self._id = id
+        self.__post_init__()
+
+    @classmethod
+    def _view(cls, snd, tick):
+        voice = cls.__new__(cls)
+        voice._snd = snd
+        voice._tick = tick
+        return voice
 
-    #def __init__(self):
-    #    pass
-    
     def __post_init__(self):
         if type(self.n) is str:
             self.set_by_str(self.n)
-    
+
+    @property
+    def n(self):
+        if self._snd is None:
+            return self._n
+        return _unpack(self._snd._notes[self._tick])
+    @n.setter
+    def n(self, val):
+        if self._snd is None:
+            self._n = val
+        else:
+            self._snd._write("_notes", self._tick, val)
+
+    @property
+    def t(self):
+        if self._snd is None:
+            return self._t
+        return _unpack(self._snd._tones[self._tick])
+    @t.setter
+    def t(self, val):
+        if self._snd is None:
+            self._t = val
+        else:
+            self._snd._write("_tones", self._tick, val)
+
+    @property
+    def v(self):
+        if self._snd is None:
+            return self._v
+        return _unpack(self._snd._volumes[self._tick])
+    @v.setter
+    def v(self, val):
+        if self._snd is None:
+            self._v = val
+        else:
+            self._snd._write("_volumes", self._tick, val)
+
+    @property
+    def f(self):
+        if self._snd is None:
+            return self._f
+        return _unpack(self._snd._effects[self._tick])
+    @f.setter
+    def f(self, val):
+        if self._snd is None:
+            self._f = val
+        else:
+            self._snd._write("_effects", self._tick, val)
+
+    @property
+    def id(self):
+        if self._snd is None:
+            return self._id
+        return self._snd._get_id(self._tick)
+    @id.setter
+    def id(self, val):
+        if self._snd is None:
+            self._id = val
+        else:
+            self._snd._set_id(self._tick, val)
+
     def set_voice(self, v):
         self.id = v.id
         self.n = v.n
@@ -171,7 +275,7 @@ class LCVoice:
 
     def set_note_by_name(self, name):
         self.n = lcl.get_note_num(name)
-    
+
     def set_tone_by_char(self, name):
         res = lcl.get_tone_num(name)
         if res is None:
@@ -215,7 +319,7 @@ class LCVoice:
         self.f = 0
 
     def is_clear(self):
-        return self.n is None 
+        return self.n is None
 
     def note_name(self):
         return lcl.get_note_name(self.n)
@@ -232,69 +336,221 @@ class LCVoice:
     def voice_name(self):
         return self.note_name() + ":" + self.tone_char() + self.volume_char() + self.effect_char()
 
+    # copies are always detached from the sound
+    def __copy__(self):
+        return LCVoice(self.n, self.t, self.v, self.f, self.id)
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __eq__(self, other):
+        if not isinstance(other, LCVoice):
+            return NotImplemented
+        return (self.n, self.t, self.v, self.f, self.id) == (other.n, other.t, other.v, other.f, other.id)
+
     def __repr__(self):
         return "LCVoice(" + self.voice_name() + ")"
 
 
-@dataclass
-class LCSound(MutableSequence):
-    #vl:LCVoiceList = None#dataclasses.field(default_factory=list)
-    vl:list = dataclasses.field(default_factory=list)
+# empty value inside the packed LCSound arrays (signed byte)
+NONE_VALUE = -128
 
-    def __post_init__(self):
-        self.set_size(MAX_SOUND_LENGTH)
+_version_counter = itertools.count(1)
+
+def _pack(val):
+    return NONE_VALUE if val is None else val
+
+def _unpack(val):
+    return None if val == NONE_VALUE else val
+
+# byte to byte tables turning packed LCSound values into pyxel's numbers
+def _make_value_table(func):
+    return bytes([func(b - 256 if b >= 128 else b) & 0xFF for b in range(256)])
+
+def _translate(values, table):
+    return array("b", values.tobytes().translate(table)).tolist()
+
+_LCSOUND_ARRAYS = ("_notes", "_tones", "_volumes", "_effects")
+
+_PYXEL_NOTE_TABLE = _make_value_table(lambda n: n if 0 <= n < len(NOTEKEY_NAME_LIST) * 5 else -1)
+_PYXEL_TONE_TABLE = _make_value_table(lambda t: 0 if t in (NONE_VALUE, -1) else t)
+_PYXEL_VOLUME_TABLE = _make_value_table(lambda v: 5 if v in (NONE_VALUE, -1) else v)
+_PYXEL_EFFECT_TABLE = _make_value_table(lambda f: 0 if f in (NONE_VALUE, -1) else f)
+
+
+class LCSound(MutableSequence):
+    # notes, tones, volumes and effects are kept in four arrays of signed bytes.
+    # voice ids are rare, so they live in a dict {tick: id} created on demand.
+    # _version changes on every edit of the sound data and is unique among all
+    # sounds, so an uploaded pyxel sound is known to be up to date by its version.
+    # a snapshot() shares the arrays (and the version) until one side is edited,
+    # the first edit copies them (copy on write).
+
+    _shared = False
+
+    def __init__(self, vl=None):
+        if vl is None:
+            self.set_size(MAX_SOUND_LENGTH)
+        else:
+            self.vl = vl
 
     def set_size(self, size):
-        self.vl.clear()
-        for i in range(size):
-            self.vl.append(LCVoice())
+        self._notes = array("b", [NONE_VALUE]) * size
+        self._tones = array("b", [0]) * size
+        self._volumes = array("b", [5]) * size
+        self._effects = array("b", [0]) * size
+        self._ids = None
+        self._touch()
+
+    @property
+    def version(self):
+        return self._version
+
+    def _touch(self):
+        self._version = next(_version_counter)
+
+    # called before the arrays or the ids are changed in place
+    def _unshare(self):
+        if self._shared:
+            self._notes = array("b", self._notes)
+            self._tones = array("b", self._tones)
+            self._volumes = array("b", self._volumes)
+            self._effects = array("b", self._effects)
+            self._ids = dict(self._ids) if self._ids else None
+            self._shared = False
+
+    # the four arrays of ticks start - end (exclusive) as bytes
+    def _columns(self, start, end):
+        return [getattr(self, name)[start:end].tobytes() for name in _LCSOUND_ARRAYS]
+
+    # overwrites ticks from start with the columns, ids {tick: id} replace the ids there
+    def _set_columns(self, start, columns, ids=None):
+        self._unshare()
+        end = start + len(columns[0])
+        for name, data in zip(_LCSOUND_ARRAYS, columns):
+            getattr(self, name)[start:end] = array("b", data)
+        if self._ids:
+            for tick in [t for t in self._ids if start <= t < end]:
+                del self._ids[tick]
+        if ids:
+            for tick, id in ids.items():
+                self._set_id(tick, id)
+        self._touch()
+
+    def snapshot(self):
+        snd = LCSound.__new__(LCSound)
+        snd.__dict__.update(self.__dict__)
+        snd._shared = self._shared = True
+        return snd
+
+    def __copy__(self):
+        return self.snapshot()
+
+    def __deepcopy__(self, memo):
+        return self.snapshot()
+
+    @property
+    def vl(self):
+        return [LCVoice._view(self, i) for i in range(len(self._notes))]
+    @vl.setter
+    def vl(self, voices):
+        self._notes = array("b", [_pack(v.n) for v in voices])
+        self._tones = array("b", [_pack(v.t) for v in voices])
+        self._volumes = array("b", [_pack(v.v) for v in voices])
+        self._effects = array("b", [_pack(v.f) for v in voices])
+        self._ids = None
+        for i, v in enumerate(voices):
+            if v.id is not None:
+                self._set_id(i, v.id)
+        self._touch()
+
+    def _write(self, name, tick, val):
+        self._unshare()
+        getattr(self, name)[tick] = _pack(val)
+        self._touch()
+
+    def _get_id(self, tick):
+        if self._ids is None:
+            return None
+        return self._ids.get(tick)
+
+    def _set_id(self, tick, val):
+        self._unshare()
+        if val is None:
+            if self._ids is not None:
+                self._ids.pop(tick, None)
+            return
+        if self._ids is None:
+            self._ids = {}
+        self._ids[tick] = val
+
+    def _id_list(self):
+        return [self._get_id(i) for i in range(len(self._notes))]
+
+    def _set_id_list(self, ids):
+        self._ids = None
+        for i, id in enumerate(ids):
+            self._set_id(i, id)
+
+    def _store(self, tick, voice):
+        n, t, v, f, id = voice.n, voice.t, voice.v, voice.f, voice.id
+        self._unshare()
+        self._notes[tick] = _pack(n)
+        self._tones[tick] = _pack(t)
+        self._volumes[tick] = _pack(v)
+        self._effects[tick] = _pack(f)
+        self._set_id(tick, id)
+        self._touch()
 
     def get_voice(self, tick):
-        if tick < len(self.vl):
-            return self.vl[tick]
+        if tick < len(self._notes):
+            return LCVoice._view(self, tick)
 
     def set_voice(self, tick, voice):
-        if tick < len(self.vl):
-            self.vl[tick].set_voice(voice)
-    
+        if tick < len(self._notes):
+            self._store(tick, voice)
+
     def set_note_to_all(self, val):
-        for v in self.vl:
-            v.n = val
+        self._notes = array("b", [_pack(val)]) * len(self._notes)
+        self._touch()
 
     def set_tone_to_all(self, val):
-        for v in self.vl:
-            v.t = val
+        self._tones = array("b", [_pack(val)]) * len(self._tones)
+        self._touch()
 
     def set_volume_to_all(self, val):
-        for v in self.vl:
-            v.v = val
+        self._volumes = array("b", [_pack(val)]) * len(self._volumes)
+        self._touch()
 
     def set_effect_to_all(self, val):
-        for v in self.vl:
-            v.f = val
+        self._effects = array("b", [_pack(val)]) * len(self._effects)
+        self._touch()
 
     def add_voice(self, voices):
-        self.vl += voices
+        self.add_voices(voices)
 
     def add_voices(self, voices):
-        self.vl += voices
+        if isinstance(voices, LCVoice):
+            voices = [voices]
+        for v in voices:
+            self.insert(len(self._notes), v)
 
     def set_notes_by_str(self, s):
         for i,x in enumerate(s):
-            self.vl[i].set_note_by_name(x)
+            self[i].set_note_by_name(x)
 
     def set_tones_by_str(self, s):
         for i,x in enumerate(s):
-            self.vl[i].set_tone_by_char(x)
+            self[i].set_tone_by_char(x)
 
     def set_volumes_by_str(self, s):
         for i,x in enumerate(s):
-            self.vl[i].set_volume_by_char(x)
+            self[i].set_volume_by_char(x)
 
     def set_effects_by_str(self, s):
         for i,x in enumerate(s):
-            self.vl[i].set_effect_by_char(x)
-    
+            self[i].set_effect_by_char(x)
+
     def _clear_inside(self, voice_list, low, high ):
         for v in voice_list:
             if v.n is not None and v.n >= low and v.n <= high:
@@ -302,7 +558,7 @@ class LCSound(MutableSequence):
         return voice_list
 
     def _clear_outside(self, voice_list, low, high ):
-        
+
         for v in voice_list:
             debug(str(v) + " " + str(low) + " " + str(high))
             if v.n is not None and (v.n < low or v.n > high):
@@ -316,7 +572,7 @@ class LCSound(MutableSequence):
         if high is None:
             high = 9999
 
-        notes = self.vl[start_tick:end_tick+1]
+        notes = self[start_tick:end_tick+1]
         self._clear_inside(notes, low, high)
         debug(str(notes))
 
@@ -337,80 +593,67 @@ class LCSound(MutableSequence):
         return new_notes
 
     def copy_notes(self, start_tick, end_tick, mode=None, low=None, high=None):
-        
+
         if low is None:
             low = 0
         if high is None:
             high = 9999
 
         # copy
-        new_notes = copy.deepcopy( self.vl[start_tick:end_tick+1] )
+        new_notes = copy.deepcopy( self[start_tick:end_tick+1] )
         self._clear_outside(new_notes, low=low, high=high)
 
         return new_notes
 
     def paste_notes(self, start_tick, notes, mode=None, low=None, high=None):
-        
+
         for i, n in enumerate(notes):
             idx = start_tick + i
-            if idx < len(self.vl):
-                self.vl[idx] = copy.deepcopy( n )
-    
+            if idx < len(self._notes):
+                self._store(idx, n)
+
     @property
     def notes(self):
-        l = []
-        for n in self.vl:
-            l.append(n.n)
-        return l
+        return [_unpack(x) for x in self._notes]
 
     @property
     def tones(self):
-        l = []
-        for n in self.vl:
-            l.append(n.t)
-        return l
+        return [_unpack(x) for x in self._tones]
 
     @property
     def volumes(self):
-        l = []
-        for n in self.vl:
-            l.append(n.v)
-        return l
+        return [_unpack(x) for x in self._volumes]
 
     @property
     def effects(self):
-        l = []
-        for n in self.vl:
-            l.append(n.f)
-        return l
+        return [_unpack(x) for x in self._effects]
+
+    # note / tone / volume / effect lists as pyxel's numbers (rest is -1)
+    def pyxel_values(self):
+        return (_translate(self._notes, _PYXEL_NOTE_TABLE),
+                _translate(self._tones, _PYXEL_TONE_TABLE),
+                _translate(self._volumes, _PYXEL_VOLUME_TABLE),
+                _translate(self._effects, _PYXEL_EFFECT_TABLE))
+
+    # sounds with the same key are set to pyxel with the same values
+    def content_key(self):
+        return self._notes.tobytes() + self._tones.tobytes() + self._volumes.tobytes() + self._effects.tobytes()
 
     def notes_str(self):
-        s = ""
-        for n in self.vl:
-            s += n.note_name()
-        return s
+        return "".join([lcl.get_note_name(_unpack(x)) for x in self._notes])
 
     def tones_str(self):
-        s = ""
-        for n in self.vl:
-            s += n.tone_char()
-        return s
+        return "".join([lcl.get_tone_name(_unpack(x)) for x in self._tones])
 
     def volumes_str(self):
-        s = ""
-        for n in self.vl:
-            s += n.volume_char()
-        return s
+        return "".join([lcl.get_volume_name(_unpack(x)) for x in self._volumes])
 
     def effects_str(self):
-        s = ""
-        for n in self.vl:
-            s += n.effect_char()
-        return s
-    
+        return "".join([lcl.get_effect_name(_unpack(x)) for x in self._effects])
+
     def set_voices(self, voices):
         if type(voices) is pyxel.Sound:
-            vs = voices[0:len(self.vl)]
+            vs = voices[0:len(self)]
             for v in vs:
                 self.set_voice(v)
             #for i in range(32-len(vs)):
@@ -418,32 +661,64 @@ class LCSound(MutableSequence):
             #self.vl = voices
 
     def set_voice_by_index(self, index, voice):
-        self.vl[index] = copy.copy(voice)
-
-    def __len__(self):
-        return len(self.vl)
+        self._store(index, voice)
 
     def __getitem__(self, index) -> LCVoice:
-        return self.vl[index]
+        if isinstance(index, slice):
+            return [LCVoice._view(self, i) for i in range(*index.indices(len(self._notes)))]
+        if index < 0:
+            index += len(self._notes)
+        if index < 0 or index >= len(self._notes):
+            raise IndexError("LCSound index out of range")
+        return LCVoice._view(self, index)
 
     def __setitem__(self, index, val):
         if type(val) is LCVoice:
-            self.vl[index] = val
+            self._store(index, val)
 
     def __delitem__(self, index):
-        del self.vl[index]
+        ids = self._id_list() if self._ids else None
+        self._unshare()
+        del self._notes[index]
+        del self._tones[index]
+        del self._volumes[index]
+        del self._effects[index]
+        if ids is not None:
+            del ids[index]
+            self._set_id_list(ids)
+        self._touch()
 
     def insert(self, index, val):
         if type(val) is LCVoice:
-            self.vl.insert(index, val)
+            ids = self._id_list() if self._ids or val.id is not None else None
+            self._unshare()
+            self._notes.insert(index, _pack(val.n))
+            self._tones.insert(index, _pack(val.t))
+            self._volumes.insert(index, _pack(val.v))
+            self._effects.insert(index, _pack(val.f))
+            if ids is not None:
+                ids.insert(index, val.id)
+                self._set_id_list(ids)
+            self._touch()
 
     def clear(self):
-        for i in range(len(self.vl)):
-            self.vl[i].clear()
-            #self.set_voice(i, LCVoice())
+        size = len(self._notes)
+        self._notes = array("b", [NONE_VALUE]) * size
+        self._tones = array("b", [0]) * size
+        self._volumes = array("b", [0]) * size
+        self._effects = array("b", [0]) * size
+        self._ids = None
+        self._touch()
 
     def __len__(self):
-        return len(self.vl)
+        return len(self._notes)
+
+    def __eq__(self, other):
+        if not isinstance(other, LCSound):
+            return NotImplemented
+        return (self._notes == other._notes and self._tones == other._tones
+                and self._volumes == other._volumes and self._effects == other._effects
+                and (self._ids or None) == (other._ids or None))
 
     def __repr__(self):
         s = "LCSound(vl=["
@@ -471,6 +746,14 @@ class LCSoundList(MutableSequence):
         snd = self.sl[bar]
         return snd.get_voice(tick)
 
+    def versions(self):
+        return [snd.version for snd in self.sl]
+
+    def snapshot(self):
+        obj = LCSoundList.__new__(LCSoundList)
+        obj.sl = [snd.snapshot() for snd in self.sl]
+        return obj
+
     def __getitem__(self, index) -> LCSound:
         return self.sl[index]
 
@@ -519,6 +802,11 @@ class LCChannelList(MutableSequence):
         sl = self.channels[ch]
         return sl[bar]
 
+    def snapshot(self):
+        obj = LCChannelList.__new__(LCChannelList)
+        obj.channels = [sl.snapshot() for sl in self.channels]
+        return obj
+
     def clear(self):
         for sl in self.channels:
             sl.clear()
@@ -551,6 +839,50 @@ class LCChannelList(MutableSequence):
         s += "])"
         return s
 
+# Range clipboard ---
+# a selection over bars and channels, kept as bytes columns per channel.
+# the pitch filter works on the whole selection at once: a translate table
+# marks the ticks to clear (0xff) and the columns are masked as big ints.
+
+@dataclass
+class LCClip:
+    channels:tuple = ()     # channel each row was copied from
+    length:int = 0          # ticks of each row
+    rows:list = dataclasses.field(default_factory=list)     # [notes, tones, volumes, effects] bytes per channel
+    ids:list = dataclasses.field(default_factory=list)      # {tick offset: id} per channel
+
+
+# 0xff for the notes to clear: notes outside low - high, or inside with inside=True.
+# rests are never cleared
+def _note_mask_table(low, high, inside):
+    low = 0 if low is None else low
+    high = 9999 if high is None else high
+    return _make_value_table(lambda n: 0 if n == NONE_VALUE or (low <= n <= high) != inside else -1)
+
+_CLEARED_VOICE = (NONE_VALUE & 0xFF, 0, 0, 0)     # LCVoice.clear()
+
+def _clear_masked(columns, mask, ids=None, offset=0):
+    size = len(mask)
+    m = int.from_bytes(mask, "big")
+    keep = ~m
+    cleared = []
+    for data, fill in zip(columns, _CLEARED_VOICE):
+        val = int.from_bytes(data, "big") & keep
+        if fill:
+            val |= int.from_bytes(bytes([fill]) * size, "big") & m
+        cleared.append(val.to_bytes(size, "big"))
+    if ids:
+        ids = {t: id for t, id in ids.items() if not mask[t - offset]}
+    return cleared, ids
+
+# (bar, start tick, end tick exclusive) of each bar of a range
+def _range_cells(sl, start_bar, start_tick, end_bar, end_tick):
+    for bar in range(start_bar, min(end_bar + 1, len(sl))):
+        start = start_tick if bar == start_bar else 0
+        end = end_tick + 1 if bar == end_bar else len(sl[bar])
+        yield bar, start, min(end, len(sl[bar]))
+
+
 @dataclass
 class LCMusic:
     speed:int = 30
@@ -611,6 +943,72 @@ class LCMusic:
         for ch_id in range(len(self.channels)):
             self.paste_notes(ch_id, bar, start_tick, notes_list[ch_id], mode=mode, low=low, high=high)
     
+    # channels=None selects every channel, the range ends at end_bar / end_tick (inclusive).
+    # notes outside low - high are cleared in the clip like copy_notes()
+    def copy_range(self, start_bar, start_tick, end_bar, end_tick, channels=None, low=None, high=None) -> LCClip:
+        if channels is None:
+            channels = range(len(self.channels))
+        clip = LCClip(tuple(channels))
+        table = _note_mask_table(low, high, False)
+
+        for ch in clip.channels:
+            sl = self.channels[ch]
+            columns = [[], [], [], []]
+            ids = {}
+            length = 0
+            for bar, start, end in _range_cells(sl, start_bar, start_tick, end_bar, end_tick):
+                snd = sl[bar]
+                for col, data in zip(columns, snd._columns(start, end)):
+                    col.append(data)
+                if snd._ids:
+                    ids.update({length + t - start: id for t, id in snd._ids.items() if start <= t < end})
+                length += end - start
+            row = [b"".join(col) for col in columns]
+            row, ids = _clear_masked(row, row[0].translate(table), ids)
+            clip.rows.append(row)
+            clip.ids.append(ids)
+            clip.length = length
+        return clip
+
+    # notes inside low - high are cleared from the range like cut_notes()
+    def cut_range(self, start_bar, start_tick, end_bar, end_tick, channels=None, low=None, high=None) -> LCClip:
+        clip = self.copy_range(start_bar, start_tick, end_bar, end_tick, channels, low, high)
+        table = _note_mask_table(low, high, True)
+
+        for ch in clip.channels:
+            sl = self.channels[ch]
+            for bar, start, end in _range_cells(sl, start_bar, start_tick, end_bar, end_tick):
+                snd = sl[bar]
+                columns = snd._columns(start, end)
+                mask = columns[0].translate(table)
+                if mask.count(0) == len(mask):
+                    continue
+                ids = {t: id for t, id in snd._ids.items() if start <= t < end} if snd._ids else None
+                columns, ids = _clear_masked(columns, mask, ids, start)
+                snd._set_columns(start, columns, ids)
+        return clip
+
+    # pastes the clip rows to its channels (or to channels) from start_bar / start_tick,
+    # ticks past the last bar are dropped
+    def paste_range(self, clip:LCClip, start_bar, start_tick, channels=None):
+        if channels is None:
+            channels = clip.channels
+        for ch, row, ids in zip(channels, clip.rows, clip.ids):
+            sl = self.channels[ch]
+            pos = 0
+            bar = start_bar
+            tick = start_tick
+            while pos < clip.length and bar < len(sl):
+                snd = sl[bar]
+                size = min(len(snd) - tick, clip.length - pos)
+                if size > 0:
+                    part = {tick + t - pos: id for t, id in ids.items() if pos <= t < pos + size}
+                    snd._set_columns(tick, [data[pos:pos + size] for data in row], part)
+                    pos += size
+                bar += 1
+                tick = 0
+        return True
+
     def import_from_pyxrec(self, file_path, ref_channels):
         return
         if os.path.exists(file_path):
@@ -649,6 +1047,66 @@ class LCMusic:
     def get_lcsound(self, ch, bar):
         return self.channels.get_lcsound(ch, bar)
 
+    # applies transform_tables() to the bars start_bar - end_bar (inclusive) of the channels
+    # (code_channels with code=True). returns the number of changed sounds
+    def apply_tables(self, tables, channels=None, start_bar=0, end_bar=None, code=False):
+        chs = self.code_channels if code else self.channels
+        if channels is None:
+            channels = range(len(chs))
+        changed = 0
+        for ch in channels:
+            sl = chs[ch]
+            last = len(sl) - 1 if end_bar is None else min(end_bar, len(sl) - 1)
+            for bar in range(start_bar, last + 1):
+                snd = sl[bar]
+                dirty = False
+                for name, table in zip(_LCSOUND_ARRAYS, tables):
+                    if table == _IDENTITY_TABLE:
+                        continue
+                    data = getattr(snd, name).tobytes()
+                    new = data.translate(table)
+                    if new != data:
+                        setattr(snd, name, array("b", new))
+                        dirty = True
+                if dirty:
+                    snd._touch()
+                    changed += 1
+        return changed
+
+    # transform(transpose=2, scale=keys, ...), see transform_tables()
+    def transform(self, channels=None, start_bar=0, end_bar=None, code=False, **kwargs):
+        return self.apply_tables(lcl.transform_tables(**kwargs), channels, start_bar, end_bar, code)
+
+    # a copy that shares the sound data with this music until either is edited
+    # (for undo history). only the edited bars are copied.
+    def snapshot(self):
+        obj = LCMusic.__new__(LCMusic)
+        obj.__dict__.update(self.__dict__)
+        obj.channels = self.channels.snapshot()
+        obj.code_channels = self.code_channels.snapshot()
+        obj.rhythms = copy.deepcopy(self.rhythms)
+        return obj
+
+    # a value that changes with every edit of the music: the versions of its
+    # sounds and its other values (see LCData.release_music())
+    def edit_state(self):
+        versions = tuple(snd.version for chs in (self.channels, self.code_channels) for sl in chs for snd in sl)
+        values = {k: v for k, v in self.__dict__.items() if k not in ("channels", "code_channels", "rhythms")}
+        return versions, values, copy.deepcopy(self.rhythms)
+
+    # (ch, bar) cells that differ from what load_lcmusic() uploaded for this music
+    def dirty_cells(self):
+        loaded = lcl.lcm is self and lcl.loaded_channels is not None
+        cells = []
+        for ch, sl in enumerate(self.channels):
+            for bar, snd in enumerate(sl):
+                if loaded and ch < lcl.loaded_channels and bar < lcl.loaded_pages:
+                    snd_idx = lcl.loaded_sound_table[ch][bar]
+                    if lcl.loaded_sound_versions.get(snd_idx) == lcl._sound_state(snd, self.speed, lcl.loaded_dedupe):
+                        continue
+                cells.append((ch, bar))
+        return cells
+
     @property
     def ch(self, index):
         return self.channels[index]
@@ -673,11 +1131,13 @@ class LCMusic:
         if type(val) is LCRhythmList:
             self.rhythms[index] = val
 
-    def to_json(self):
-        pass
+    # file is a path or a file object, the text is returned without one
+    def to_json(self, file=None, lcl_format:int=1):
+        return lcl.write_json(self, file, lcl_format)
 
-    def to_midi(self):
-        pass
+    # file is a path or a binary file object, see write_midi()
+    def to_midi(self, file, loop_count:int=0):
+        return lcl.write_midi(self, file, loop_count)
 
     def load_json(self):
         pass
@@ -698,11 +1158,17 @@ class LCMusic:
         s += "])"
         return s
 
+
+_decode_lock = threading.Lock()
+
 @dataclass
 class LCData:
     musics:list = dataclasses.field(default_factory=list)
 
     voice_samples = []
+    _lazy = None            # file spans of the musics not decoded yet (lazy load)
+    _auto_release = False   # release other decoded musics when one is selected
+    _decoded = None         # index -> LCMusic.edit_state() when it was decoded
 
     def __post_init__(self):
         self.musics = []
@@ -710,36 +1176,323 @@ class LCData:
             self.musics.append(LCMusic())
     
     def get_music(self, index) -> LCMusic:
-        return self.musics[index]
+        return self[index]
 
     def update_music(self, index, music_data:LCMusic):
-        self.musics[index] = copy.deepcopy(music_data)
+        self.musics[index] = music_data.snapshot()
+        self._unlink(index)
+
+    def is_decoded(self, index):
+        return self.musics[index] is not None
+
+    # drop a decoded music; it is decoded from the file again on the next access.
+    # a music edited since it was decoded and musics set by update_music()
+    # are never released.
+    def release_music(self, index):
+        if self._lazy is None or not self._lazy.has(index):
+            return False
+        music = self.musics[index]
+        if music is not None and music.edit_state() != self._decoded.get(index):
+            debug("lcmusic %d was edited, it is not released", index)
+            return False
+        self.musics[index] = None
+        return True
+
+    def release_unused(self, keep=()):
+        for i in range(len(self.musics)):
+            if i not in keep and self.musics[i] is not None:
+                self.release_music(i)
+
+    def _unlink(self, index):
+        if self._lazy is not None:
+            self._lazy.forget(index)
+
+    def _decode_all(self):
+        if self._lazy is not None:
+            for i in range(len(self.musics)):
+                self[i]
+            self._lazy = None
 
     def clear(self):
-        for sl in self.musics:
-            sl.clear()
+        for i in range(len(self.musics)):
+            self[i].clear()
+
+    # file is a path or a file object, the text is returned without one
+    def to_json(self, file=None, lcl_format:int=1):
+        return lcl.write_json(self, file, lcl_format)
 
     def __len__(self):
         return len(self.musics)
 
     def __getitem__(self, index)-> LCMusic:
-        return self.musics[index]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.musics)))]
+        music = self.musics[index]
+        if music is None:
+            # preload() decodes on a worker thread
+            with _decode_lock:
+                music = self.musics[index]
+                if music is None:
+                    music = self._lazy.decode(index % len(self.musics))
+                    if self._decoded is None:
+                        self._decoded = {}
+                    self._decoded[index % len(self.musics)] = music.edit_state()
+                    self.musics[index] = music
+        return music
 
     def __setitem__(self, index, val):
         if type(val) is LCMusic:
             self.musics[index] = val
+            self._unlink(index % len(self.musics))
 
     def __delitem__(self, index):
+        self._decode_all()
         del self.musics[index]
 
     def insert(self, index, val):
         if type(val) is LCVoice:
+            self._decode_all()
             self.musics.insert(index, val)
 
 
 
+# Headless backend ------------------------------------
+# a stand-in of pyxel without window and audio. it keeps the sound and music
+# banks and records the play calls, so load(), update_note_mixing(), setup_music()
+# ... run on a server / CI box at full speed. see use_backend().
+
+class HeadlessSoundData:
+    def __init__(self):
+        self.note = array("i")
+        self.tone = array("i")
+        self.volume = array("i")
+        self.effect = array("i")
+        self.speed = 30
+
+
+class HeadlessMusicData:
+    def __init__(self):
+        self.ch = [[] for i in range(4)]
+
+
+def _resize(data, n):
+    data[:] = array("i", [0]) * n   # keeps the array object
+
+
+class HeadlessCore:
+
+    def __init__(self):
+        self.sounds = {}
+        self.musics = {}
+
+    def sound(self, index, system=0):
+        return self.sounds.setdefault((index, bool(system)), HeadlessSoundData())
+
+    def music(self, index):
+        return self.musics.setdefault(index, HeadlessMusicData())
+
+    def sound_speed_getter(self, obj):
+        return obj.speed
+
+    # the getters give the address of the data like pyxel.core does (see _set_c_list())
+    def sound_note_getter(self, obj):
+        return obj.note.buffer_info()[0]
+
+    def sound_tone_getter(self, obj):
+        return obj.tone.buffer_info()[0]
+
+    def sound_volume_getter(self, obj):
+        return obj.volume.buffer_info()[0]
+
+    def sound_effect_getter(self, obj):
+        return obj.effect.buffer_info()[0]
+
+    def sound_note_length_setter(self, obj, n):
+        _resize(obj.note, n)
+
+    def sound_tone_length_setter(self, obj, n):
+        _resize(obj.tone, n)
+
+    def sound_volume_length_setter(self, obj, n):
+        _resize(obj.volume, n)
+
+    def sound_effect_length_setter(self, obj, n):
+        _resize(obj.effect, n)
+
+
+class HeadlessSound:
+
+    def __init__(self, c_obj):
+        self._c_obj = c_obj
+        self._note = c_obj.note
+        self._tone = c_obj.tone
+        self._volume = c_obj.volume
+        self._effect = c_obj.effect
+
+    @property
+    def note(self):
+        return self._note
+
+    @property
+    def tone(self):
+        return self._tone
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @property
+    def effect(self):
+        return self._effect
+
+    @property
+    def speed(self):
+        return self._c_obj.speed
+    @speed.setter
+    def speed(self, val):
+        self._c_obj.speed = val
+
+    def set(self, note, tone, volume, effect, speed):
+        self.set_note(note)
+        self.set_tone(tone)
+        self.set_volume(volume)
+        self.set_effect(effect)
+        self.speed = speed
+
+    # same notation as pyxel: c3 c#3 d-3 ... r (rest)
+    def set_note(self, data):
+        data = data.lower().replace(" ", "")
+        notes = []
+        i = 0
+        while i < len(data):
+            c = data[i]
+            i += 1
+            if c == "r":
+                notes.append(-1)
+                continue
+            n = "c d ef g a b".index(c)
+            if data[i] == "#":
+                n += 1
+                i += 1
+            elif data[i] == "-":
+                n -= 1
+                i += 1
+            notes.append(n + int(data[i]) * 12)
+            i += 1
+        self._note[:] = array("i", notes)
+
+    def set_tone(self, data):
+        self._tone[:] = array("i", ["tspn".index(c) for c in data.lower().replace(" ", "")])
+
+    def set_volume(self, data):
+        self._volume[:] = array("i", [int(c) for c in data.replace(" ", "")])
+
+    def set_effect(self, data):
+        self._effect[:] = array("i", ["nsvf".index(c) for c in data.lower().replace(" ", "")])
+
+
+class HeadlessMusic:
+
+    def __init__(self, c_obj):
+        self._c_obj = c_obj
+
+    @property
+    def ch0(self):
+        return self._c_obj.ch[0]
+
+    @property
+    def ch1(self):
+        return self._c_obj.ch[1]
+
+    @property
+    def ch2(self):
+        return self._c_obj.ch[2]
+
+    @property
+    def ch3(self):
+        return self._c_obj.ch[3]
+
+    def set(self, ch0, ch1, ch2, ch3):
+        self._c_obj.ch = [list(ch0), list(ch1), list(ch2), list(ch3)]
+
+
+class HeadlessPyxel:
+    USER_SOUND_BANK_COUNT = 64
+    SOUND_BANK_FOR_SYSTEM = 64
+    MUSIC_BANK_COUNT = 8
+    MUSIC_CHANNEL_COUNT = 4
+    DEFAULT_CAPTION = "Pyxel"
+    DEFAULT_SCALE = 0
+    DEFAULT_PALETTE = [0x000000, 0x2B335F, 0x7E2072, 0x19959C, 0x8B4852, 0x395C98, 0xA9C1FF, 0xEEEEEE,
+                       0xD4186C, 0xD38441, 0xE9C35B, 0x70C6A9, 0x7696DE, 0xA3A3A3, 0xFF9798, 0xEDC7B0]
+    DEFAULT_FPS = 30
+    DEFAULT_QUIT_KEY = 256
+
+    Sound = HeadlessSound
+    Music = HeadlessMusic
+
+    def __init__(self):
+        self.core = HeadlessCore()
+        self._sound_bank = {}
+        self._music_bank = {}
+        self.calls = []         # (name, args...) of play / playm / stop
+        self.play_positions = {}    # ch -> play_pos(), set it to move the play position
+
+    def sound(self, snd, *, system=False):
+        if snd not in self._sound_bank:
+            self._sound_bank[snd] = self.Sound(self.core.sound(snd, system))
+        return self._sound_bank[snd]
+
+    def music(self, msc):
+        if msc not in self._music_bank:
+            self._music_bank[msc] = self.Music(self.core.music(msc))
+        return self._music_bank[msc]
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def load(self, *args, **kwargs):
+        pass
+
+    def run(self, update, draw):
+        pass
+
+    def play_pos(self, ch):
+        return self.play_positions.get(ch, -1)
+
+    def play(self, ch, snd, *, loop=False):
+        self.calls.append(("play", ch, snd, loop))
+        self.play_positions[ch] = 0
+
+    def playm(self, msc, *, loop=False):
+        self.calls.append(("playm", msc, loop))
+        m = self.music(msc)
+        for ch, sl in enumerate([m.ch0, m.ch1, m.ch2, m.ch3]):
+            if len(sl) > 0:
+                self.play_positions[ch] = 0
+
+    def stop(self, ch=-1):
+        self.calls.append(("stop", ch))
+        if ch < 0:
+            self.play_positions.clear()
+        else:
+            self.play_positions.pop(ch, None)
+
+
+if pyxel is None:
+    pyxel = HeadlessPyxel()
+    core = pyxel.core
+
+
 # Extended Pyxel Audio class --------------------------
 
+def _set_c_list(c_obj, data_getter, length_setter, values):
+    buf = array("i", values)    # int32 like pyxel's data
+    length_setter(c_obj, len(buf))
+    if len(buf) > 0:
+        ctypes.memmove(data_getter(c_obj), buf.buffer_info()[0], len(buf) * buf.itemsize)
+
+
 class ExSound(pyxel.Sound):
 
     def __init__(self, c_obj: Any):
@@ -829,9 +1582,17 @@ class ExSound(pyxel.Sound):
             lcs[i] = v
         return lcs
     
+    # write numbers straight into the sound data, no MML string on the way
+    def set_values(self, notes, tones, volumes, effects, speed=30):
+        _set_c_list(self._c_obj, core.sound_note_getter, core.sound_note_length_setter, notes)
+        _set_c_list(self._c_obj, core.sound_tone_getter, core.sound_tone_length_setter, tones)
+        _set_c_list(self._c_obj, core.sound_volume_getter, core.sound_volume_length_setter, volumes)
+        _set_c_list(self._c_obj, core.sound_effect_getter, core.sound_effect_length_setter, effects)
+        self.speed = speed
+
     def set_by_lcsound(self, lcs:LCSound, speed=30):
-        vl = lcs
-        self.set(vl.notes_str(), vl.tones_str(), vl.volumes_str(), vl.effects_str(), speed )
+        notes, tones, volumes, effects = lcs.pyxel_values()
+        self.set_values(notes, tones, volumes, effects, speed)
         """
         self.set_note(vl.notes_str())
         self.set_tone(vl.tones_str())
@@ -893,7 +1654,7 @@ class ExSound(pyxel.Sound):
                 else:
                     self.id = None
             
-            print(notes_str, tones_str, volumes_str, effects_str, self.speed)
+            debug("%s %s %s %s %d", notes_str, tones_str, volumes_str, effects_str, self.speed)
             self.set(notes_str, tones_str, volumes_str, effects_str, self.speed)
 
         debug("LCSound set_by_str()_end,")
@@ -939,6 +1700,37 @@ class ExMusic(pyxel.Music):
         return s
 
 
+# backend: "pyxel", "headless" or an object like HeadlessPyxel.
+# the sound bank state of lcl is reset, returns the backend.
+def use_backend(backend="pyxel"):
+    global pyxel
+    global core
+
+    if backend == "pyxel":
+        import pyxel as backend
+    elif backend == "headless":
+        backend = HeadlessPyxel()
+
+    pyxel = backend
+    core = backend.core
+    ExSound.__bases__ = (backend.Sound,)
+    ExMusic.__bases__ = (backend.Music,)
+
+    lcl.sound_bank = SoundBank()
+    lcl.sfx_table.clear()
+    lcl.sfx_lengths.clear()
+    lcl.sfx_strs.clear()
+    lcl.channel_pool = ChannelPool()
+    lcl.preloads.clear()
+    lcl.load_jobs.clear()
+    lcl.music_stream = None
+    lcl.music_queue = None
+    lcl.music_loop_switch = None
+    invalidate_loaded_sounds()
+    _clear_loaded_lcmusic()
+    return backend
+
+
 # * pyxel init wrapper *
 def init(width: int,
     height: int,
@@ -982,12 +1774,17 @@ def get_loaded_lcmusic_index() -> int:
 
 
 def get_target_sound_id(ch_id, bar:int):
+    if loaded_sound_table is None:
+        return False
+
     if ch_id >= loaded_channels:    # 指定の小節が実際サウンドに読み込まれてない場合
         return False
     
-    id = bar * loaded_channels + ch_id
-    if loaded_to_tail:
-        id += _get_start_index_for_tail(loaded_channels, loaded_pages, music_play_start_bar)
+    if bar < 0 or bar >= loaded_pages:
+        return False
+
+    # bars with the same content share one sound (see load_lcmusic(dedupe=True))
+    id = loaded_sound_table[ch_id][bar]
 
     return id
 
@@ -1107,6 +1904,47 @@ def get_scaled_note(note:int, scale_key_list:list):
         n -= 1
     return n
 
+# Transforms ---
+# a transform is four byte to byte tables (notes, tones, volumes, effects) applied
+# with bytes.translate. each step is a table and the steps are composed into one,
+# so a whole music (or library) is remapped in one pass per array.
+
+_IDENTITY_TABLE = bytes(range(256))
+MAX_NOTE = len(NOTEKEY_NAME_LIST) * 5 - 1
+
+def _compose_tables(*tables):
+    result = _IDENTITY_TABLE
+    for table in tables:
+        result = result.translate(table)
+    return result
+
+def _map_table(mapping):
+    if mapping is None:
+        return _IDENTITY_TABLE
+    if not isinstance(mapping, dict):
+        mapping = dict(enumerate(mapping))
+    return _make_value_table(lambda x: mapping.get(x, x))
+
+# transpose: semitones, notes are clamped to 0 - MAX_NOTE.
+# scale: 12 key flags like get_scaled_note() (applied after transpose).
+# volume_scale / volume_add: v * volume_scale + volume_add clamped to volume_min - volume_max.
+# tone_map / effect_map: {from: to} or a list indexed by the old value.
+# rests and empty values (None, -1) are left as they are, a table is the
+# identity when its step is not asked for.
+def transform_tables(transpose:int=0, scale=None, volume_scale:float=1.0, volume_add:int=0,
+                     volume_min:int=0, volume_max:int=len(VOLUME_NAME_LIST) - 1, tone_map=None, effect_map=None):
+    is_note = lambda n: 0 <= n <= MAX_NOTE
+    notes = [_make_value_table(lambda n: min(max(n + transpose, 0), MAX_NOTE) if is_note(n) else n)]
+    if scale is not None:
+        notes.append(_make_value_table(lambda n: get_scaled_note(n, scale) if is_note(n) else n))
+
+    volumes = _IDENTITY_TABLE
+    if (volume_scale, volume_add, volume_min, volume_max) != (1.0, 0, 0, len(VOLUME_NAME_LIST) - 1):
+        volumes = _make_value_table(lambda v: v if v in (NONE_VALUE, -1) else
+                                    min(max(int(round(v * volume_scale)) + volume_add, volume_min), volume_max))
+
+    return (_compose_tables(*notes), _map_table(tone_map), volumes, _map_table(effect_map))
+
 
 def mixing_note(un, cn):
     #if un["note"] is not None and un["note"] >= 0 or (un["note"]==-1 and cn["note"]is None or cn["note"]):
@@ -1162,12 +2000,140 @@ def play_voice_str(fmt_str, ch_id=0):
     v.set_by_str(fmt_str)
     lcl.play_voice(v, ch_id=ch_id)
 
-def sfx(ch_id=SFX_DEFAULT_CH):
+# sfx("name") plays a sfx of register_sfx(), sfx(ch_id) plays the system sound of sfx_str().
+# a named sfx gets its channel from channel_pool unless ch is given.
+def sfx(ch_id=SFX_DEFAULT_CH, ch=None, priority=0):
+    if type(ch_id) is str:
+        if ch_id not in lcl.sfx_strs:
+            error("sfx is not registered: " + ch_id)
+            return False
+        snd_idx = _sfx_sound(ch_id)
+        if ch is None:
+            return lcl.channel_pool.play(snd_idx, priority, lcl.sfx_lengths[ch_id]) is not None
+        pyxel.play(ch, snd_idx, loop=False)
+        return True
+
     pyxel.play(ch_id, pyxel.SOUND_BANK_FOR_SYSTEM, loop=False)
 
 def sfx_str(fmt_str):
     lcl.play_str(fmt_str, ch_id=SFX_DEFAULT_CH)
 
+# parse the format string of sfx_str() once into an own sound of the bank, play it with sfx(name).
+# the sound is taken from the sfx slots of reserve_sfx(), else from a free sound
+# of the bank (from the head, music uses the tail). nothing is freed for a sfx,
+# a music may take back a free sound later. without an own sound the sfx is set
+# to the system sound on each play (like sfx_str()).
+def register_sfx(name:str, fmt_str:str):
+    lcl.sound_bank.free(("sfx", name))
+    lcl.sfx_table.pop(name, None)
+    lcl.sfx_strs[name] = fmt_str
+
+    snd = lcl.sound(pyxel.SOUND_BANK_FOR_SYSTEM, system=True)
+    snd.set_by_str(fmt_str)
+    lcl.sfx_lengths[name] = len(snd.note) * snd.speed / 120
+    _sfx_sound(name)
+    return True
+
+def unregister_sfx(name:str):
+    lcl.sound_bank.free(("sfx", name))
+    lcl.sfx_table.pop(name, None)
+    lcl.sfx_lengths.pop(name, None)
+    lcl.sfx_strs.pop(name, None)
+
+# sets aside the sounds start - end for sfx, music never uses them
+def reserve_sfx(start:int, end:int):
+    lcl.sound_bank.reserve(start, end, sfx=True)
+
+# sound index of a registered sfx, set up again if a music took its sound
+def _sfx_sound(name):
+    key = ("sfx", name)
+    entry = lcl.sound_bank.get(key)
+    if entry is not None and lcl.sfx_table.get(name) == entry.base:
+        lcl.sound_bank.touch(key)
+        return entry.base
+
+    entry = lcl.sound_bank.alloc_free(key, 1, from_tail=False)
+    if entry is None:
+        lcl.sfx_table.pop(name, None)
+        lcl.sound(pyxel.SOUND_BANK_FOR_SYSTEM, system=True).set_by_str(lcl.sfx_strs[name])
+        return pyxel.SOUND_BANK_FOR_SYSTEM
+
+    lcl.sound(entry.base).set_by_str(lcl.sfx_strs[name])
+    lcl.sfx_table[name] = entry.base
+    return entry.base
+
+
+# SFX channel pool -------------------------------------
+@dataclass
+class ChannelState:
+    priority:int = 0
+    end_time:float = 0.0
+
+# picks the channel of each sfx: a free one, else it steals the sfx with the lowest
+# priority (the one closest to its end first). the channels of the music are only
+# taken by a sfx with a priority over music_priority.
+class ChannelPool:
+
+    def __init__(self, channels=None, music_priority=100):
+        if channels is None:
+            channels = range(SFX_DEFAULT_CH + 1)
+        self.channels = list(channels)
+        self.music_priority = music_priority
+        self.sfx = {}           # ch -> ChannelState
+        self.music = set()      # channels the music plays on
+
+    def music_started(self, channels):
+        self.music = set(channels)
+        for ch in channels:
+            self.sfx.pop(ch, None)
+
+    def is_busy(self, ch):
+        return pyxel.play_pos(ch) >= 0
+
+    # None when every channel plays something more important
+    def acquire(self, priority=0):
+        now = time.perf_counter()
+        best = None
+        best_rank = None
+
+        # the music uses the low channels
+        for ch in reversed(self.channels):
+            if not self.is_busy(ch):
+                return ch
+
+            st = self.sfx.get(ch)
+            if st is not None:
+                if st.priority > priority:
+                    continue
+                rank = (st.priority, st.end_time - now)
+            elif ch in self.music:
+                if self.music_priority >= priority:
+                    continue
+                rank = (self.music_priority, float("inf"))
+            else:
+                continue    # played outside of lcl
+
+            if best_rank is None or rank < best_rank:
+                best = ch
+                best_rank = rank
+
+        return best
+
+    # length: seconds of the sound
+    def play(self, snd_idx, priority=0, length=0.0):
+        ch = self.acquire(priority)
+        if ch is None:
+            debug("no channel for sfx %d (priority %d)", snd_idx, priority)
+            return None
+
+        self.music.discard(ch)
+        self.sfx[ch] = ChannelState(priority, time.perf_counter() + length)
+        pyxel.play(ch, snd_idx, loop=False)
+        return ch
+
+
+channel_pool = ChannelPool()
+
 
 
 # ------------------------------------------------------
@@ -1178,21 +2144,46 @@ def init( ):
     pass
     #rtn = load(lc_json_file_path)
 
-def load(lc_json_file_path):
+# lazy=True only locates each music in the file, a music is decoded when
+# lcd[i] / get_music(i) first touches it (lcm stays None until then).
+# release_unused=True drops the other decoded musics when one is loaded.
+# cache=True reads the musics from a binary cache next to the file
+# (written on the first load), see write_cache().
+def load(lc_json_file_path, lazy=False, release_unused=False, cache=False):
     global lcjson
     global lcd
     global lcm
 
-    if not os.path.isfile(lc_json_file_path):
+    doc = read_lcjson(lc_json_file_path, lazy, cache)
+    if doc is None:
         return False
 
-    with open(lc_json_file_path) as f:
-        lcjson = f.read()
-        lcjson = json.loads(lcjson, object_hook=json_loader_hook)
-        lcd = lcjson["lcdata"]
-        lcm = lcd[0]
-        return True
-    return False
+    lcjson = doc
+    lcd = lcjson["lcdata"]
+    lcd._auto_release = release_unused
+    lcm = None if lcd._lazy is not None else lcd[0]
+    return True
+
+# the document of a file without touching lcjson / lcd / lcm (None if missing)
+def read_lcjson(lc_json_file_path, lazy=False, cache=False):
+    if not os.path.isfile(lc_json_file_path):
+        return None
+
+    source = open_cache(lc_json_file_path) if cache else None
+    if source is not None:
+        return source.to_doc(lazy)
+
+    with open(lc_json_file_path, "rb") as f:
+        s = f.read()
+    if lazy and not cache:
+        doc = lazy_json_loader(s, lc_json_file_path)
+    else:
+        doc = json_loader(s)
+    if cache and write_cache(doc["lcdata"], lc_json_file_path, s, doc) and lazy:
+        source = open_cache(lc_json_file_path, s)
+        if source is not None:
+            doc = source.to_doc(lazy)
+    return doc
 
 def mixing_sound(snd_idx, code_idx):
 
@@ -1233,7 +2224,9 @@ def non_remix_bar_sound(bar):
     return limited_output_stack
 
 
-def mixing_bar_sound(bar):
+def mixing_bar_sound(bar, music=None):
+    if music is None:
+        music = lcm
 
     #music = pyxel.music(0)
     #r_ptn = parent._songs["rhythm_pattern"][bar]
@@ -1242,7 +2235,7 @@ def mixing_bar_sound(bar):
     # user ch:0 -> code ch:0-> user ch:1 ... -> user ch:3 -> code ch:3 の順に積む
     ch_num=0
     sound_stack = []
-    for ch in lcm.channels:
+    for ch in music.channels:
         #print(ch[bar])
         lcs = ch[bar]
         #us = pyxel.sound(snd_idx)
@@ -1281,60 +2274,284 @@ def _get_start_index_for_tail(load_channels=4, load_pages=16, start_bar=0):
     return pyxel.USER_SOUND_BANK_COUNT - (load_channels * load_pages )# - start_bar * load_channels
 
 
-def update_note_mixing(load_channels=4, load_pages=16, load_to_tail=True, channel_compress=False):
+# Sound bank allocator ----------------------------------
+# keeps several lcmusics (and other users of the bank) resident at once.
+# each key owns one contiguous block, when the bank is full the least
+# recently used blocks are freed.
+@dataclass
+class SoundBankEntry:
+    key:Any = None
+    base:int = 0
+    count:int = 0
+    owner:Any = None
+    pinned:bool = False     # never freed for other keys (sfx)
+    slots:dict = None       # content key -> slot of a dedupe block, see _dedupe_slots()
+
+class SoundBank:
+
+    def __init__(self, start=0, end=None):
+        if end is None:
+            end = pyxel.USER_SOUND_BANK_COUNT
+        self.start = start
+        self.end = end
+        self.entries = {}   # key -> SoundBankEntry, least recently used first
+        self.reserved = set()
+        self.sfx_slots = set()  # reserved sounds that alloc_free(..., sfx) may use
+
+    # sound indices lcl must not use (sounds of the game itself),
+    # sfx=True sets them aside for register_sfx() instead
+    def reserve(self, start, end, sfx=False):
+        self.reserved.update(range(start, end))
+        if sfx:
+            self.sfx_slots.update(range(start, end))
+        for e in list(self.entries.values()):
+            if not set(range(start, end)).isdisjoint(range(e.base, e.base + e.count)):
+                self.free(e.key)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def touch(self, key):
+        e = self.entries.pop(key)
+        self.entries[key] = e
+        return e
+
+    def free(self, key):
+        e = self.entries.pop(key, None)
+        if e is None:
+            return
+        debug("sound bank free: %s %d-%d", str(key), e.base, e.base + e.count - 1)
+        for i in range(e.base, e.base + e.count):
+            lcl.loaded_sound_versions.pop(i, None)
+
+    def clear(self):
+        for key in list(self.entries):
+            self.free(key)
+
+    def _find(self, count, from_tail, slots=None):
+        used = set(self.reserved)
+        if slots is not None:
+            used -= slots
+        for e in self.entries.values():
+            used.update(range(e.base, e.base + e.count))
+        bases = range(self.start, self.end - count + 1)
+        if slots is not None:
+            bases = [base for base in sorted(slots) if set(range(base, base + count)) <= slots]
+        if from_tail:
+            bases = reversed(bases)
+        for base in bases:
+            if used.isdisjoint(range(base, base + count)):
+                return base
+        return None
 
-    lcl.used_sound_list.clear()
+    # returns (entry, resident). resident=True means the block was already
+    # allocated for this key and owner, so its sounds are still there.
+    # keys in keep and pinned blocks are never freed, keys in spare only
+    # when nothing else can be freed.
+    def alloc(self, key, count, from_tail=True, owner=None, keep=(), pin=False, spare=()):
+        e = self.entries.get(key)
+        if e is not None:
+            if e.count == count and e.owner is owner:
+                return self.touch(key), True
+            self.free(key)
+
+        base = self._find(count, from_tail)
+        while base is None:
+            victims = [k for k, e in self.entries.items() if k not in keep and not e.pinned]
+            victims.sort(key=lambda k: k in spare)
+            if not victims:
+                error("sound bank is full")
+                return None, False
+            self.free(victims[0])
+            base = self._find(count, from_tail)
+
+        e = SoundBankEntry(key, base, count, owner, pin)
+        self.entries[key] = e
+        debug("sound bank alloc: %s %d-%d", str(key), base, base + count - 1)
+        return e, False
+
+    # like alloc() but only takes free sounds, nothing is freed.
+    # the sfx slots of reserve() are tried first for a sfx key
+    def alloc_free(self, key, count, from_tail=True, owner=None):
+        self.free(key)
+        base = None
+        if key[0] == "sfx" and self.sfx_slots:
+            base = self._find(count, from_tail, self.sfx_slots)
+        pin = base is not None
+        if base is None:
+            base = self._find(count, from_tail)
+        if base is None:
+            debug("sound bank has no free sound for %s", str(key))
+            return None
+
+        e = SoundBankEntry(key, base, count, owner, pin)
+        self.entries[key] = e
+        debug("sound bank alloc: %s %d-%d", str(key), base, base + count - 1)
+        return e
+
+    def sound_indices(self, key):
+        e = self.entries.get(key)
+        if e is None:
+            return []
+        return list(range(e.base, e.base + e.count))
+
+
+sound_bank = SoundBank()
+
+
+# LCSounds to set in slot order and the slot of each bar: table[ch][bar].
+# dedupe=True gives the bars with the same content one shared slot.
+def _bar_layout(load_channels=4, load_pages=16, channel_compress=False, dedupe=False, music=None):
+    layout = ([], [[] for i in range(load_channels)])
+    for h in _bar_layout_steps(layout, load_channels, load_pages, channel_compress, dedupe, music):
+        pass
+    return layout
 
-    for h in range(0, load_pages):
-        str_notes   = ["","","",""]
-        str_tones   = ["","","",""]
-        str_volumes = ["","","",""]
-        str_effects = ["","","",""]
 
+# fills layout = (sounds, table) and yields after each bar
+def _bar_layout_steps(layout, load_channels=4, load_pages=16, channel_compress=False, dedupe=False, music=None):
+    if music is None:
+        music = lcm
+
+    sounds, table = layout
+    slots = {}
+
+    for h in range(0, load_pages):
         if channel_compress:
-            mixed_note_list = mixing_bar_sound(h)   # 1小節分のノート
+            mixed_note_list = mixing_bar_sound(h, music)   # 1小節分のノート
         else:
-            mixed_note_list = non_remix_bar_sound(h)
-        
-        #debug("mixed_note_list:%s", str(mixed_note_list))
-        
-        # 1列ごとのノート情報 32回ループ
-        for i in range(lcl.MAX_SOUND_LENGTH):
+            mixed_note_list = [music.channels[i][h] for i in range(load_channels)]
 
-            # 1ノート情報ごと 最大4回ループ
-            for j in range(load_channels):
-                lcs = mixed_note_list[j]
-                v = lcs[i]
+        for i in range(load_channels):
+            lcs = mixed_note_list[i]
+            slot = len(sounds)
+            if dedupe:
+                slot = slots.setdefault(lcs.content_key(), slot)
+            if slot == len(sounds):
+                sounds.append(lcs)
+            table[i].append(slot)
+
+        yield h
+
+
+DEDUPE_SPARE_SOUNDS = 4     # free sounds of a new dedupe block for the bars edited later
+
+# the slot of each content of a dedupe layout in the block of key.
+# a content keeps its slot of the resident block and a new one takes a slot
+# no bar uses any more, so an edit sets only its own sound and the block
+# keeps its size (it only grows when all of its slots are used).
+# returns (slot of each content, block size)
+def _dedupe_slots(key, content_keys, capacity):
+    entry = lcl.sound_bank.get(key)
+    old = entry.slots if entry is not None and entry.slots is not None else {}
+    count = len(content_keys)
+    if entry is not None and count <= entry.count:
+        count = entry.count
+    else:
+        count = min(count + DEDUPE_SPARE_SOUNDS, capacity)
 
-                if v.n is not None and v.n>=0:
-                    str_notes[j] +=  lcl.get_note_name( v.n )
-                else:
-                    str_notes[j] += "R"
-                str_tones[j]   += v.tone_char()
-                str_volumes[j] += v.volume_char()
-                str_effects[j] += v.effect_char()
+    slots = [old.get(k) for k in content_keys]
+    free = iter(sorted(set(range(count)).difference(slots)))
+    return [next(free) if slot is None else slot for slot in slots], count
+
+
+# items in slot order (None for the free slots)
+def _place(items, slots, count):
+    placed = [None] * count
+    for slot, item in zip(slots, items):
+        placed[slot] = item
+    return placed
+
+
+# the layout of _bar_layout() placed in the block of key
+def _block_layout(key, layout, load_channels=4, load_pages=16, dedupe=False):
+    if not dedupe:
+        return layout
+    sounds, table = layout
+    slots, count = _dedupe_slots(key, [lcs.content_key() for lcs in sounds], load_channels * load_pages)
+    return _place(sounds, slots, count), [[slots[i] for i in row] for row in table]
+
+
+def _set_block_slots(entry, sounds, dedupe):
+    if dedupe:
+        entry.slots = {lcs.content_key(): slot for slot, lcs in enumerate(sounds) if lcs is not None}
 
-        # 最終的にsoundにセット
-        for i in range(load_channels):
-            snd_idx = i + (h*load_channels)
-            if load_to_tail:
-                snd_idx += _get_start_index_for_tail(load_channels, load_pages)
-            debug("snd_idx: %d", snd_idx )
-            lcl.sound(snd_idx).set(str_notes[i], str_tones[i], str_volumes[i], str_effects[i], lcm.speed)
-            lcl.used_sound_list.append(snd_idx)
+
+def _sound_state(lcs, speed, dedupe=False):
+    if dedupe:
+        return (lcs.content_key(), speed)
+    return (lcs.version, speed)
+
+
+# only the sounds whose LCSound was edited since the last upload are set again
+# (see loaded_sound_versions), force=True sets all of them.
+# base is the first sound index, None means the tail layout of load_to_tail.
+def update_note_mixing(load_channels=4, load_pages=16, load_to_tail=True, channel_compress=False, force=False, base=None,
+                       dedupe=False, layout=None):
+
+    if layout is None:
+        layout = _bar_layout(load_channels, load_pages, channel_compress, dedupe)
+    sounds, table = layout
+
+    if base is None:
+        base = pyxel.USER_SOUND_BANK_COUNT - len(sounds) if load_to_tail else 0
+
+    lcl.used_sound_list.clear()
+    upload_count = 0
+
+    # 最終的にsoundにセット (数値のまま書き込む)
+    for slot, lcs in enumerate(sounds):
+        if lcs is None:
+            continue
+        snd_idx = base + slot
+        lcl.used_sound_list.append(snd_idx)
+        if _upload_sound(snd_idx, lcs, lcm.speed, channel_compress, dedupe, force):
+            upload_count += 1
+
+    return upload_count
+
+
+# returns False when the sound already has the LCSound
+def _upload_sound(snd_idx, lcs, speed, channel_compress=False, dedupe=False, force=False):
+    state = _sound_state(lcs, speed, dedupe)
+    if channel_compress and not dedupe:
+        lcl.loaded_sound_versions.pop(snd_idx, None)
+    elif not force and lcl.loaded_sound_versions.get(snd_idx) == state:
+        return False
+    else:
+        lcl.loaded_sound_versions[snd_idx] = state
+
+    debug("snd_idx: %d", snd_idx )
+    lcl.sound(snd_idx).set_by_lcsound(lcs, speed)
+    return True
+
+
+# call this when the pyxel sounds were changed outside of lcl
+# (pyxel.load(), pyxel.init(), own sound(i).set() ...)
+def invalidate_loaded_sounds():
+    lcl.loaded_sound_versions.clear()
 
 
 def load_lcm_from_lcd(lcm_index):
     global lcm
     lcm = lcd[lcm_index]
+    if lcd._auto_release:
+        keep = [lcm_index] + [p.lcm_index for p in lcl.preloads.values()]
+        keep += [k[1] for k in lcl.sound_bank.entries if k[0] == "lcmusic"]
+        lcd.release_unused(keep=keep)
 
 
-def load_lcmusic(lcm_index:int, load_channels=4, load_pages=16, load_to_tail=True, channel_compress=False, load_to_lcm=True):
+def load_lcmusic(lcm_index:int, load_channels=4, load_pages=16, load_to_tail=True, channel_compress=False, load_to_lcm=True,
+                 dedupe=True):
     global lcm
     global loaded_lcmusic_index
     global loaded_channels
     global loaded_pages
     global loaded_to_tail
+    global loaded_sound_base
+    global loaded_sound_key
+    global loaded_sound_table
+    global loaded_dedupe
 
     debug("lcl.load_lcmusic()")
     debug("load_sound len(lcd): " + str(len(lcd)))
@@ -1343,17 +2560,269 @@ def load_lcmusic(lcm_index:int, load_channels=4, load_pages=16, load_to_tail=Tru
         error("lcmusic index is out of range")
         return False
     
+    # a preload of this music is finished here
+    key = ("lcmusic", lcm_index, load_channels, load_pages, channel_compress, dedupe)
+    if key in lcl.preloads:
+        _commit_preloads(wait=True, key=key)
+
     if load_to_lcm:
         load_lcm_from_lcd(lcm_index)
 
-    update_note_mixing(load_channels, load_pages, load_to_tail, channel_compress)
+    # dedupe=True sets each different bar once, the bars with the same content share a sound
+    layout = _bar_layout(load_channels, load_pages, channel_compress, dedupe)
+    layout = _block_layout(key, layout, load_channels, load_pages, dedupe)
+
+    # load_to_tail=True takes the block from the tail of the bank
+    entry, resident = lcl.sound_bank.alloc(key, len(layout[0]), load_to_tail, owner=lcm, spare=_job_keys())
+    if entry is None:
+        return False
+    _set_block_slots(entry, layout[0], dedupe)
+
+    # a resident lcmusic only compares the versions of its sounds
+    debug("resident: %s", str(resident))
+    update_note_mixing(load_channels, load_pages, load_to_tail, channel_compress, base=entry.base,
+                       dedupe=dedupe, layout=layout)
     loaded_lcmusic_index = lcm_index
+    loaded_sound_base = entry.base
+    loaded_sound_table = [[entry.base + slot for slot in row] for row in layout[1]]
+    loaded_dedupe = dedupe
+    loaded_sound_key = key
     loaded_channels = load_channels
     loaded_pages = load_pages
     loaded_to_tail = load_to_tail
 
 
-def setup_music(music_id=7, bar:int=0, load_channels=4, load_pages=16, load_to_tail=True):
+def _clear_loaded_lcmusic():
+    global loaded_lcmusic_index
+    global loaded_channels
+    global loaded_pages
+    global loaded_to_tail
+    global loaded_sound_base
+    global loaded_sound_key
+    global loaded_sound_table
+
+    loaded_lcmusic_index = None
+    loaded_channels = None
+    loaded_pages = None
+    loaded_to_tail = None
+    loaded_sound_base = None
+    loaded_sound_key = None
+    loaded_sound_table = None
+
+
+# Background preload ---------------------------------
+# the music is decoded and its pyxel values are made on a worker thread,
+# update() (or the next load_lcmusic()) sets them to the sound bank.
+class _Preload:
+
+    def __init__(self, lcm_index, load_channels, load_pages, load_to_tail, channel_compress, dedupe):
+        self.lcm_index = lcm_index
+        self.load_channels = load_channels
+        self.load_pages = load_pages
+        self.load_to_tail = load_to_tail
+        self.channel_compress = channel_compress
+        self.dedupe = dedupe
+        self.key = ("lcmusic", lcm_index, load_channels, load_pages, channel_compress, dedupe)
+        self.music = None
+        self.states = None
+        self.values = None
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        try:
+            music = lcd[self.lcm_index]
+            sounds, table = _bar_layout(self.load_channels, self.load_pages, self.channel_compress, self.dedupe, music)
+            # the states are taken before the values, an edit in between is set again by load_lcmusic()
+            self.states = [_sound_state(lcs, music.speed, self.dedupe) for lcs in sounds]
+            self.values = [lcs.pyxel_values() for lcs in sounds]
+            self.music = music
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    # main thread only
+    def commit(self):
+        if self.error is not None:
+            error("lcl: preload of lcmusic %d failed: %s", self.lcm_index, str(self.error))
+            return False
+
+        # never evict what is playing (or being loaded)
+        keep = [lcl.loaded_sound_key] + _job_keys()
+        if lcl.music_stream is not None:
+            keep.append(("stream", lcl.music_stream.music_id))
+
+        states, values_list = self.states, self.values
+        if self.dedupe:
+            content_keys = [state[0] for state in states]
+            slots, count = _dedupe_slots(self.key, content_keys, self.load_channels * self.load_pages)
+            states, values_list = _place(states, slots, count), _place(values_list, slots, count)
+
+        entry, resident = lcl.sound_bank.alloc(self.key, len(values_list), self.load_to_tail, owner=self.music, keep=keep)
+        if entry is None:
+            return False
+        if self.dedupe:
+            entry.slots = dict(zip(content_keys, slots))
+
+        for slot, values in enumerate(values_list):
+            snd_idx = entry.base + slot
+            state = states[slot]
+            if values is None or lcl.loaded_sound_versions.get(snd_idx) == state:
+                continue
+            lcl.sound(snd_idx).set_values(*values, speed=self.music.speed)
+            if not (self.channel_compress and not self.dedupe):
+                lcl.loaded_sound_versions[snd_idx] = state
+        return True
+
+
+# start preparing a music for play() / load_lcmusic() with the same settings.
+# call update() every frame, it sets the prepared sounds on the main thread.
+def preload(lcm_index:int, load_channels:int=4, load_pages:int=16, load_to_tail:bool=True,
+            channel_compress:bool=False, dedupe:bool=True):
+
+    if lcm_index >= count_lcmusic() or lcm_index <= -1:
+        error("lcmusic index is out of range")
+        return False
+
+    p = _Preload(lcm_index, load_channels, load_pages, load_to_tail, channel_compress, dedupe)
+    if p.key in lcl.preloads:
+        return True
+    lcl.preloads[p.key] = p
+    p.thread.start()
+    return True
+
+
+def is_preloading():
+    return len(lcl.preloads) > 0
+
+
+# wait=True blocks until the worker threads finished
+def _commit_preloads(wait=False, key=None):
+    for k, p in list(lcl.preloads.items()):
+        if key is not None and k != key:
+            continue
+        if wait:
+            p.done.wait()
+        if p.done.is_set():
+            del lcl.preloads[k]
+            p.commit()
+
+
+# Frame budgeted load ---------------------------------
+# the same work as load_lcmusic() (decode, layout, upload) split into small steps:
+#   job = lcl.begin_load(i)
+#   job.step(budget_ms=2)   # every frame until job.done
+# when it is done, play(i) with the same settings finds the music resident.
+# the block of a running job is evicted last, a play() that still needs it
+# stops the job (result False). cancel() a job that is not stepped any more.
+class LoadJob:
+
+    def __init__(self, lcm_index, load_channels=4, load_pages=16, load_to_tail=True, channel_compress=False, dedupe=True):
+        self.lcm_index = lcm_index
+        self.load_channels = load_channels
+        self.load_pages = load_pages
+        self.load_to_tail = load_to_tail
+        self.channel_compress = channel_compress
+        self.dedupe = dedupe
+        self.key = ("lcmusic", lcm_index, load_channels, load_pages, channel_compress, dedupe)
+        self.done = False
+        self.result = None      # True / False when done
+        self.upload_count = 0
+        self._units = 0
+        self._total_units = 1 + load_pages + load_channels * load_pages
+        self._steps = self._run()
+
+    @property
+    def progress(self):
+        if self.done:
+            return 1.0
+        return min(self._units / self._total_units, 1.0)
+
+    # runs until budget_ms is used (at least one unit of work), returns done
+    def step(self, budget_ms=2):
+        end_time = time.perf_counter() + budget_ms / 1000
+        while not self.done:
+            try:
+                next(self._steps)
+            except StopIteration:
+                self._finish()
+                break
+            self._units += 1
+            if time.perf_counter() >= end_time:
+                break
+        return self.done
+
+    # stop a job that is not stepped any more, its block can be evicted again
+    def cancel(self):
+        if not self.done:
+            self._steps.close()
+            self.result = False
+            self._finish()
+
+    def _finish(self):
+        self.done = True
+        if self in lcl.load_jobs:
+            lcl.load_jobs.remove(self)
+
+    def _run(self):
+        music = lcd[self.lcm_index]
+        yield
+
+        layout = ([], [[] for i in range(self.load_channels)])
+        for h in _bar_layout_steps(layout, self.load_channels, self.load_pages, self.channel_compress, self.dedupe, music):
+            yield
+
+        # never evict what is playing (or being loaded by another job)
+        keep = [lcl.loaded_sound_key] + _job_keys()
+        if lcl.music_stream is not None:
+            keep.append(("stream", lcl.music_stream.music_id))
+
+        layout = _block_layout(self.key, layout, self.load_channels, self.load_pages, self.dedupe)
+        entry, resident = lcl.sound_bank.alloc(self.key, len(layout[0]), self.load_to_tail, owner=music, keep=keep)
+        if entry is None:
+            self.result = False
+            return
+        _set_block_slots(entry, layout[0], self.dedupe)
+
+        self._total_units = 1 + self.load_pages + len(layout[0])
+        for slot, lcs in enumerate(layout[0]):
+            # the block is gone when a load_lcmusic() with the same settings
+            # (or sound_bank.clear() / reserve()) took it between two steps
+            if lcl.sound_bank.get(self.key) is not entry:
+                warning("lcl: the sound bank block of load job %d was taken, the job is stopped", self.lcm_index)
+                self.result = False
+                return
+            if lcs is not None and _upload_sound(entry.base + slot, lcs, music.speed, self.channel_compress, self.dedupe):
+                self.upload_count += 1
+            yield
+
+        self.result = True
+
+
+def begin_load(lcm_index:int, load_channels:int=4, load_pages:int=16, load_to_tail:bool=True,
+               channel_compress:bool=False, dedupe:bool=True):
+
+    if lcm_index >= count_lcmusic() or lcm_index <= -1:
+        error("lcmusic index is out of range")
+        return None
+
+    job = LoadJob(lcm_index, load_channels, load_pages, load_to_tail, channel_compress, dedupe)
+    lcl.load_jobs.append(job)
+    return job
+
+
+# the blocks of the running load jobs
+def _job_keys():
+    return [job.key for job in lcl.load_jobs]
+
+
+# loop region musics get the loop region LOOP_PASSES times after the first pass
+# (like pyxel's loop, it goes on without update()). with loop=True, update()
+# replaces it with only the loop region when the first repeat starts, so it loops seamlessly.
+LOOP_PASSES = 10     # heavy if 100
+
+def setup_music(music_id=7, bar:int=0, load_channels=4, load_pages=16, load_to_tail=True, loop=True):
     global music_play_start_bar
     music_play_start_bar = bar
 
@@ -1361,23 +2830,20 @@ def setup_music(music_id=7, bar:int=0, load_channels=4, load_pages=16, load_to_t
     debug("bar:%d load_channels:%d load_pages:%d", bar, load_channels, load_pages)
     m = lcl.music(music_id)
 
-    # if load_to_tail=True then shift load sound index
-    index_shift = _get_start_index_for_tail(load_channels, load_pages) if load_to_tail else 0
+    # sound index of each (ch, bar) of the loaded lcmusic
+    table = lcl.loaded_sound_table
 
     # if No loop end setting ----
     if lcm.loop_end_bar is None:
+        lcl.music_loop_switch = None
         pl = [[] for i in range(4)]
 
-        # calc play start bar's sound index
-        bar_idx = bar * load_channels + index_shift
-
-        # calc play end bar's sound index
-        end_bar_idx = load_pages * load_channels + index_shift
-        debug("bar_idx:%d end_bar_idx:%d", bar_idx, end_bar_idx)
+        debug("bar:%d end_bar:%d", bar, load_pages)
 
         # first time play list
         for i in range(load_channels):
-            pl[i] = list(range(bar_idx+i, end_bar_idx, load_channels))
+            pl[i] = table[i][bar:load_pages]
+        lcl.played_bars = list(range(bar, load_pages))
 
         m.set(pl[0], pl[1], pl[2], pl[3])
         debug("%s",str(pl))
@@ -1386,27 +2852,38 @@ def setup_music(music_id=7, bar:int=0, load_channels=4, load_pages=16, load_to_t
         # sound play list by channel
         pl = [[] for i in range(4)]
 
-        # calc play start bar's sound index
-        bar_idx = bar * load_channels + index_shift
-
-        # calc play end bar's sound index
-        end_bar_idx = (lcm.loop_end_bar+1) * load_channels + index_shift
+        # play end bar (only the loaded pages can be played)
+        end_bar = min(lcm.loop_end_bar + 1, load_pages)
 
-        # calc loop start bar's sound index
-        loop_start_bar_idx = 0 + index_shift
+        # loop start bar
+        loop_start_bar = 0
         if lcm.loop_start_bar is not None:
-            loop_start_bar_idx = lcm.loop_start_bar * load_channels + index_shift
+            loop_start_bar = lcm.loop_start_bar
         
-        debug("bar_idx:%d end_bar_idx:%d loop_start_bar_idx:%d", bar_idx, end_bar_idx, loop_start_bar_idx)
+        debug("bar:%d end_bar:%d loop_start_bar:%d", bar, end_bar, loop_start_bar)
+
+        # loop region play list
+        loop_pl = [[] for i in range(4)]
+        for i in range(load_channels):
+            loop_pl[i] = table[i][loop_start_bar:end_bar]
 
         # first time play list
         for i in range(load_channels):
-            pl[i] += list(range(bar_idx+i, end_bar_idx+i, load_channels))
+            pl[i] = table[i][bar:end_bar]
+        lcl.played_bars = list(range(bar, end_bar))
 
-        # after repeat loop /  near infinity times
-        for h in range(10):     # heavy if 100
-            for i in range(load_channels):
-                pl[i] += range(loop_start_bar_idx+i, end_bar_idx, load_channels)
+        lcl.music_loop_switch = None
+        if loop and (pl == loop_pl or not loop_pl[0]):
+            # pyxel loops it by itself
+            pass
+        else:
+            # first time + the repeats, update() switches to the loop region
+            if loop:
+                lcl.music_loop_switch = (music_id, len(pl[0]), loop_pl)
+            for h in range(LOOP_PASSES):
+                for i in range(load_channels):
+                    pl[i] += loop_pl[i]
+                lcl.played_bars += list(range(loop_start_bar, end_bar))
 
         debug("%s",str(pl))
         m.set(pl[0], pl[1], pl[2], pl[3])
@@ -1415,30 +2892,345 @@ def setup_music(music_id=7, bar:int=0, load_channels=4, load_pages=16, load_to_t
 def setup_music_for_page_loop(music_id=7, bar:int=0, load_channels=4, load_to_tail=True):
     global music_play_start_bar
     music_play_start_bar = bar
+    lcl.music_loop_switch = None
 
     m = lcl.music(music_id)
 
-    bar_idx = bar * load_channels
-    if load_to_tail:
-        bar_idx += _get_start_index_for_tail(load_channels, load_pages=16)
-
-    debug("bar_idx:%d ", bar_idx)
-
     pl = [[] for i in range(4)]
     for i in range(load_channels):
-        print(bar_idx+i)
-        pl[i].append(bar_idx+i)
+        pl[i].append(lcl.loaded_sound_table[i][bar])
+    lcl.played_bars = [bar]
         
     debug("%s",str(pl))
     m.set(pl[0], pl[1], pl[2], pl[3])
 
 
+# a music with loop_end_bar always loops (by pyxel or by update())
+# the music takes its channels from the sfx of channel_pool
+def _start_playm(music_id, loop):
+    pyxel.playm(music_id, loop=loop)
+    lcl.channel_pool.music_started([i for i, ch in enumerate(lcl.music(music_id).ch_all) if len(ch) > 0])
+
+
+# call this every frame (in the update function given to pyxel.run).
+# it sets finished preloads, feeds play_stream() and loops loop_end_bar musics:
+# when the first repeat of the loop region is reached, the music is played
+# again with only the loop region and loop=True, so it loops without the intro.
+def update():
+    if lcl.preloads:
+        _commit_preloads()
+
+    if lcl.music_stream is not None:
+        lcl.music_stream.update()
+        return
+
+    if lcl.music_queue is not None and lcl.music_queue.update():
+        return
+
+    if lcl.music_loop_switch is None:
+        return
+
+    music_id, spare_pos, loop_pl = lcl.music_loop_switch
+    ch = 0
+    pos = pyxel.play_pos(ch)
+    if pos < 0:     # stopped
+        lcl.music_loop_switch = None
+        return
+
+    pos = pos // 100 - spare_pos
+    if pos < 0:
+        return
+
+    # if update() was late, start from the same bar of the loop region
+    pos %= len(loop_pl[ch])
+    pl = [l[pos:] + l[:pos] for l in loop_pl]
+    bars = lcl.played_bars[spare_pos:spare_pos + len(loop_pl[ch])]
+    lcl.played_bars = bars[pos:] + bars[:pos]
+    lcl.music(music_id).set(pl[0], pl[1], pl[2], pl[3])
+    _start_playm(music_id, True)
+    lcl.music_loop_switch = None
+    if lcl.music_queue is not None:
+        lcl.music_queue.last_pos = pyxel.play_pos(ch)
+
+
+# one music of a _MusicStream, it plays the steps from origin on
+class _StreamSong:
+
+    def __init__(self, lcmusic, start_bar, loop, origin):
+        self.lcm = lcmusic
+        self.start_bar = start_bar
+        self.origin = origin
+
+        self.last_bar = len(lcmusic.channels[0]) - 1
+        self.loop_start = None
+        self.loop_end = None
+        if lcmusic.loop_end_bar is not None:
+            self.loop_start = lcmusic.loop_start_bar or 0
+            self.loop_end = lcmusic.loop_end_bar
+        elif loop:
+            self.loop_start = 0
+            self.loop_end = self.last_bar
+
+        self.blank = LCSound()
+        self.blank.set_size(len(lcmusic.channels[0][0]))
+
+    # bar of the music at a step, None after the end
+    def bar_at(self, step):
+        bar = self.start_bar + step - self.origin
+        if self.loop_end is not None and bar > self.loop_end:
+            loop_len = self.loop_end - self.loop_start + 1
+            return self.loop_start + (bar - self.loop_end - 1) % loop_len
+        if bar > self.last_bar:
+            return None
+        return bar
+
+    # the bar of the step is the loop end bar (or the last bar)
+    def is_end(self, step):
+        bar = self.bar_at(step)
+        return bar is None or bar == (self.last_bar if self.loop_end is None else self.loop_end)
+
+
+# ring buffer of ring_pages bars in the sound bank. pyxel loops over the ring
+# while update() writes the next bars into the slots that were already played.
+class _MusicStream:
+
+    def __init__(self, lcmusic, music_id, start_bar, loop, load_channels, ring_pages, base):
+        self.song = _StreamSong(lcmusic, start_bar, loop, 0)
+        self.next_song = None   # queue()d music
+        self.music_id = music_id
+        self.load_channels = load_channels
+        self.ring_pages = ring_pages
+        self.base = base
+
+        self.step = 0           # steps (played bars) since start_bar
+        self.ring_pos = 0       # ring page that is playing
+        self.uploaded = 0       # steps written to the ring
+
+    def song_at(self, step):
+        if self.next_song is not None and step >= self.next_song.origin:
+            return self.next_song
+        return self.song
+
+    def bar_at(self, step):
+        return self.song_at(step).bar_at(step)
+
+    def sound_index(self, ch_id, page):
+        return self.base + page * self.load_channels + ch_id
+
+    def upload(self, step):
+        song = self.song_at(step)
+        bar = song.bar_at(step)
+        page = step % self.ring_pages
+        for i in range(self.load_channels):
+            lcs = song.blank if bar is None else song.lcm.channels[i][bar]
+            snd_idx = self.sound_index(i, page)
+            lcl.loaded_sound_versions.pop(snd_idx, None)
+            lcl.sound(snd_idx).set_by_lcsound(lcs, song.lcm.speed)
+
+    # write the bars up to ring_pages-1 ahead of the play position
+    def fill(self):
+        while self.uploaded < self.step + self.ring_pages:
+            self.upload(self.uploaded)
+            self.uploaded += 1
+
+    def start(self):
+        self.fill()
+        pl = [[] for i in range(4)]
+        for i in range(self.load_channels):
+            pl[i] = [self.sound_index(i, k) for k in range(self.ring_pages)]
+        lcl.music(self.music_id).set(pl[0], pl[1], pl[2], pl[3])
+        _start_playm(self.music_id, True)
+
+    # the next music starts exactly at the next bar (or loop end) boundary.
+    # the bars already written after it are written again.
+    def queue(self, lcmusic, start_bar, loop, at):
+        self.advance()
+        origin = self.step + 1
+        if at == "loop_end":
+            while not self.song.is_end(origin - 1):
+                origin += 1
+        self.next_song = _StreamSong(lcmusic, start_bar, loop, origin)
+        for step in range(origin, self.uploaded):
+            self.upload(step)
+        return True
+
+    def advance(self):
+        pos = pyxel.play_pos(0)
+        if pos < 0:
+            return False
+        page = pos // 100
+        self.step += (page - self.ring_pos) % self.ring_pages
+        self.ring_pos = page
+        if self.next_song is not None and self.step >= self.next_song.origin:
+            self.song = self.next_song
+            self.next_song = None
+        return True
+
+    def update(self):
+        if not self.advance():  # stopped
+            lcl.music_stream = None
+            return
+
+        if self.bar_at(self.step) is None:
+            stop_channels(self.load_channels)
+            lcl.music_stream = None
+            return
+
+        self.fill()
+
+
+# play a music of any length with a fixed sound bank footprint (load_channels * ring_pages
+# sounds). update() has to be called every frame, it uploads the next bars.
+def play_stream(lcm_index:int, start_bar:int=0, loop:bool=False, music_id:int=7,
+                load_channels:int=4, ring_pages:int=4, load_to_tail:bool=True, load_to_lcm=True):
+    debug("lcl.play_stream()")
+
+    if lcm_index >= count_lcmusic() or lcm_index <= -1:
+        error("lcmusic index is out of range")
+        return False
+
+    if ring_pages < 2:
+        error("ring_pages must be 2 or more")
+        return False
+
+    pyxel.stop()
+
+    if load_to_lcm:
+        load_lcm_from_lcd(lcm_index)
+
+    if start_bar < 0 or start_bar >= len(lcm.channels[0]):
+        error("start bar is out of range")
+        return False
+
+    entry, resident = lcl.sound_bank.alloc(("stream", music_id), load_channels * ring_pages, load_to_tail, spare=_job_keys())
+    if entry is None:
+        return False
+    # the sounds of the last load_lcmusic() are not played any more
+    # (its block stays in the bank until it is needed)
+    _clear_loaded_lcmusic()
+
+    lcl.music_loop_switch = None
+    lcl.music_queue = None
+    lcl.music_stream = _MusicStream(lcm, music_id, start_bar, loop, load_channels, ring_pages, entry.base)
+    lcl.music_stream.start()
+    return True
+
+
+# Song queue ------------------------------------------
+class _QueuedMusic:
+
+    def __init__(self, lcm_index, at, start_bar, loop, music_id, load_channels, load_pages, load_to_tail, channel_compress, dedupe):
+        self.lcm_index = lcm_index
+        self.at = at
+        self.start_bar = start_bar
+        self.loop = loop
+        self.music_id = music_id
+        self.load_channels = load_channels
+        self.load_pages = load_pages
+        self.load_to_tail = load_to_tail
+        self.channel_compress = channel_compress
+        self.dedupe = dedupe
+        self.key = ("lcmusic", lcm_index, load_channels, load_pages, channel_compress, dedupe)
+        self.last_pos = pyxel.play_pos(0)
+
+    # the play list entry is the loop end bar (or the last loaded bar)
+    def is_end(self, index):
+        if index + 1 >= len(lcl.played_bars):
+            return True
+        end_bar = lcl.loaded_pages
+        if lcm.loop_end_bar is not None:
+            end_bar = min(lcm.loop_end_bar + 1, lcl.loaded_pages)
+        return lcl.played_bars[index] == end_bar - 1
+
+    # True when the queued music was started
+    def update(self):
+        pos = pyxel.play_pos(0)
+        last_pos = self.last_pos
+        self.last_pos = pos
+
+        if pos >= 0:
+            if last_pos < 0:
+                return False
+            index, note = divmod(pos, 100)
+            last_index, last_note = divmod(last_pos, 100)
+            if index == last_index and note >= last_note:
+                return False    # same bar
+            if self.at == "loop_end" and not self.is_end(last_index):
+                return False
+
+        # not prepared yet, wait for the next boundary
+        if self.key in lcl.preloads:
+            return False
+
+        _play_queued(self)
+        return True
+
+
+def _play_queued(q):
+    global played_page_loop_setting
+    global played_music_id
+    global played_loop
+    global played_start_bar
+
+    lcl.music_queue = None
+    if lcl.sound_bank.get(q.key) is None:
+        warning("lcl: queued lcmusic %d did not fit in the sound bank, it is loaded now", q.lcm_index)
+
+    # no pyxel.stop(), playm() replaces the play lists of the channels
+    if load_lcmusic(q.lcm_index, q.load_channels, q.load_pages, q.load_to_tail, q.channel_compress, dedupe=q.dedupe) is False:
+        return
+    setup_music(q.music_id, q.start_bar, q.load_channels, q.load_pages, q.load_to_tail, q.loop)
+    _start_playm(q.music_id, q.loop)
+
+    played_page_loop_setting = False
+    played_music_id = q.music_id
+    played_loop = q.loop
+    played_start_bar = q.start_bar
+
+
+# play a music after the current one without a stop. at="bar_end" switches
+# at the next bar boundary, at="loop_end" after the loop end bar (or the last bar).
+# the music is prepared with preload() and set to pyxel by update(), the switch
+# happens in the first update() after the boundary: up to one frame of the next
+# bar of the current music is heard before the queued music starts from its
+# first note. only a music of play_stream() is switched exactly at the boundary
+# (the next bars are written into its ring before they are played).
+def queue(lcm_index:int, at:str="bar_end", start_bar:int=0, loop:bool=False, music_id:int=None,
+          load_channels:int=4, load_pages:int=16, load_to_tail:bool=True, channel_compress:bool=False, dedupe:bool=True):
+
+    debug("lcl.queue()")
+
+    if lcm_index >= count_lcmusic() or lcm_index <= -1:
+        error("lcmusic index is out of range")
+        return False
+
+    if at not in ("bar_end", "loop_end"):
+        error("at must be bar_end or loop_end")
+        return False
+
+    if lcl.music_stream is not None:
+        return lcl.music_stream.queue(lcd[lcm_index], start_bar, loop, at)
+
+    if music_id is None:
+        music_id = played_music_id
+
+    # nothing is playing
+    if loaded_lcmusic_index is None or pyxel.play_pos(0) < 0:
+        return play(lcm_index, start_bar, loop, music_id, load_channels, load_pages, load_to_tail, channel_compress, dedupe=dedupe)
+
+    preload(lcm_index, load_channels, load_pages, load_to_tail, channel_compress, dedupe)
+    lcl.music_queue = _QueuedMusic(lcm_index, at, start_bar, loop, music_id,
+                                   load_channels, load_pages, load_to_tail, channel_compress, dedupe)
+    return True
+
+
 def stop_channels(load_channels=4):
     for i in range(load_channels):
         pyxel.stop(i)
 
 
-def play_page_loop(lcm_index:int=0, start_bar:int=0, music_id:int=7, load_channels=4, load_to_tail=True, channel_compress=False, load_to_lcm=True):
+def play_page_loop(lcm_index:int=0, start_bar:int=0, music_id:int=7, load_channels=4, load_to_tail=True, channel_compress=False, load_to_lcm=True,
+                   dedupe=True):
     
     if lcm_index >= count_lcmusic() or lcm_index <= -1:
         error("lcmusic index is out of range")
@@ -1446,18 +3238,26 @@ def play_page_loop(lcm_index:int=0, start_bar:int=0, music_id:int=7, load_channe
     
     #stop_channels(load_channels)
     pyxel.stop()
+    lcl.music_stream = None
+    lcl.music_queue = None
 
-    load_lcmusic(lcm_index, load_channels, 16, load_to_tail, channel_compress, load_to_lcm=load_to_lcm)
+    if load_lcmusic(lcm_index, load_channels, 16, load_to_tail, channel_compress, load_to_lcm=load_to_lcm, dedupe=dedupe) is False:
+        return False
     setup_music_for_page_loop(music_id, start_bar, load_channels, load_to_tail)
 
-    pyxel.playm(music_id, loop=True)
+    _start_playm(music_id, True)
     global played_page_loop_setting
+    global played_music_id
+    global played_start_bar
     played_page_loop_setting = True
+    played_music_id = music_id
+    played_start_bar = start_bar
     return True
 
 
 def play(lcm_index:int, start_bar:int=0, loop:bool=False, music_id:int=7,
-         load_channels:int=4, load_pages:int=16, load_to_tail:bool=True, channel_compress:bool=False, load_to_lcm=True):
+         load_channels:int=4, load_pages:int=16, load_to_tail:bool=True, channel_compress:bool=False, load_to_lcm=True,
+         dedupe:bool=True):
 
     debug("lcl.play()")
 
@@ -1466,21 +3266,420 @@ def play(lcm_index:int, start_bar:int=0, loop:bool=False, music_id:int=7,
         return False
 
     pyxel.stop()
+    lcl.music_stream = None
+    lcl.music_queue = None
 
-    load_lcmusic(lcm_index, load_channels, load_pages, load_to_tail, channel_compress, load_to_lcm=load_to_lcm)
-    setup_music(music_id, start_bar, load_channels, load_pages, load_to_tail)
+    if load_lcmusic(lcm_index, load_channels, load_pages, load_to_tail, channel_compress, load_to_lcm=load_to_lcm, dedupe=dedupe) is False:
+        return False
+    setup_music(music_id, start_bar, load_channels, load_pages, load_to_tail, loop)
 
-    pyxel.playm(music_id, loop=loop)
+    _start_playm(music_id, loop)
 
     global played_page_loop_setting
+    global played_music_id
+    global played_loop
+    global played_start_bar
     played_page_loop_setting = False
+    played_music_id = music_id
+    played_loop = loop
+    played_start_bar = start_bar
+    return True
+
+
+def is_loaded(lcm_index:int, load_channels:int=4, load_pages:int=16, load_to_tail:bool=True):
+    return loaded_lcmusic_index == lcm_index and loaded_channels == load_channels \
+        and loaded_pages == load_pages and loaded_to_tail == load_to_tail
+
+
+# play the loaded music from another bar without loading it again.
+# only the play list of the music is rebuilt. loop / music_id default to the last play().
+# the bar has to be inside the loaded pages.
+def seek(start_bar:int=0, loop:bool=None, music_id:int=None):
+
+    debug("lcl.seek()")
+
+    global played_music_id
+    global played_loop
+
+    if lcl.music_stream is not None:
+        error("seek() does not work on play_stream(), call play_stream() with the start bar")
+        return False
+
+    if loaded_lcmusic_index is None:
+        error("lcmusic is not loaded")
+        return False
+
+    if start_bar < 0 or start_bar >= loaded_pages:
+        error("start bar is out of range")
+        return False
+
+    if music_id is None:
+        music_id = played_music_id
+    if loop is None:
+        loop = played_loop
+
+    if played_page_loop_setting:
+        setup_music_for_page_loop(music_id, start_bar, loaded_channels, loaded_to_tail)
+        _start_playm(music_id, True)
+    else:
+        setup_music(music_id, start_bar, loaded_channels, loaded_pages, loaded_to_tail, loop)
+        _start_playm(music_id, loop)
+
+    played_music_id = music_id
+    played_loop = loop
     return True
 
 
+def replay(loop:bool=None, music_id:int=None):
+    return seek(played_start_bar, loop=loop, music_id=music_id)
+
+
+# Offline renderer ------------------------------------
+# renders a LCMusic without pyxel (NumPy is needed, it is imported on use).
+# it follows pyxel's sound model: a note lasts speed/120 sec, its frequency is
+# 440 * 2^((note-33)/12), tone T/S/P/N = triangle / square / pulse (1/4 duty) / noise,
+# effect N/S/V/F = none / slide from the previous note / vibrato / fade out.
+# the wave shapes and levels are close to pyxel's, not sample exact.
+
+RENDER_TONE_GAINS = (1.0, 0.5, 0.5, 0.5)   # T S P N
+RENDER_VIBRATO_DEPTH = 0.015
+RENDER_VIBRATO_HZ = 6.0
+RENDER_NOISE_LENGTH = 1 << 15
+
+_render_noise = None
+
+
+# bars in the order play() plays them. the loop region is played loop_count
+# times after the first pass (setup_music() loops it forever).
+def render_bar_order(lcmusic:LCMusic, start_bar:int=0, loop_count:int=1, pages:int=None):
+    if pages is None:
+        pages = len(lcmusic.channels[0])
+
+    if lcmusic.loop_end_bar is None:
+        return list(range(start_bar, pages))
+
+    end_bar = min(lcmusic.loop_end_bar + 1, pages)
+    loop_start_bar = lcmusic.loop_start_bar or 0
+    return list(range(start_bar, end_bar)) + list(range(loop_start_bar, end_bar)) * loop_count
+
+
+def _render_channel(np, notes, tones, volumes, effects, samples_per_tick, sample_rate):
+    global _render_noise
+    if _render_noise is None:
+        _render_noise = np.random.default_rng(0).choice(np.array([-1.0, 1.0], dtype=np.float32), RENDER_NOISE_LENGTH)
+
+    count = len(notes)
+    bounds = np.round(np.arange(count + 1) * samples_per_tick).astype(np.int64)
+    lengths = np.diff(bounds)
+    tick = np.repeat(np.arange(count), lengths)         # tick of each sample
+    frac = (np.arange(bounds[-1]) - bounds[tick]) / lengths[tick]   # position in the tick 0-1
+
+    rest = notes < 0
+    note_freq = 440.0 * 2.0 ** ((notes.astype(np.float64) - 33) / 12)
+
+    # the pitch of the last note before each tick (rests keep it) for the slide
+    last = np.where(rest, -1, np.arange(count))
+    last = np.maximum.accumulate(last)
+    held = np.where(last >= 0, note_freq[np.maximum(last, 0)], 0.0)
+    prev_freq = np.concatenate(([held[0]], held[:-1]))
+    prev_freq = np.where(prev_freq > 0, prev_freq, note_freq)
+
+    effect = effects[tick]
+    freq = note_freq[tick]
+    slide = effect == 1
+    freq[slide] = prev_freq[tick][slide] + (freq[slide] - prev_freq[tick][slide]) * frac[slide]
+    vibrato = effect == 2
+    t = np.arange(bounds[-1])[vibrato] / sample_rate
+    freq[vibrato] *= 1 + RENDER_VIBRATO_DEPTH * np.sin(2 * np.pi * RENDER_VIBRATO_HZ * t)
+
+    phase = np.cumsum(freq) / sample_rate
+    ph = phase % 1.0
+
+    tone = tones[tick]
+    wave_data = np.select(
+        [tone == 0, tone == 1, tone == 2],
+        [4 * np.abs(ph - 0.5) - 1,
+         np.where(ph < 0.5, 1.0, -1.0),
+         np.where(ph < 0.25, 1.0, -1.0)],
+        _render_noise[(phase * 2).astype(np.int64) % RENDER_NOISE_LENGTH])
+
+    level = volumes[tick] / 7.0 * np.asarray(RENDER_TONE_GAINS)[tone]
+    level = np.where(effect == 3, level * (1 - frac), level)
+    level[rest[tick]] = 0.0
+
+    return (wave_data * level).astype(np.float32)
+
+
+# float32 samples (-1.0 - 1.0) of the mixed channels,
+# separate=True returns one row per channel instead.
+def render_pcm(lcmusic, sample_rate:int=22050, start_bar:int=0, loop_count:int=1, pages:int=None, separate:bool=False):
+    import numpy as np
+
+    if type(lcmusic) is int:
+        lcmusic = lcd[lcmusic]
+
+    bars = render_bar_order(lcmusic, start_bar, loop_count, pages)
+    samples_per_tick = lcmusic.speed * sample_rate / 120
+
+    rows = []
+    for sl in lcmusic.channels:
+        columns = []
+        for name, table in (("_notes", _PYXEL_NOTE_TABLE), ("_tones", _PYXEL_TONE_TABLE),
+                            ("_volumes", _PYXEL_VOLUME_TABLE), ("_effects", _PYXEL_EFFECT_TABLE)):
+            data = b"".join([getattr(sl[bar], name).tobytes() for bar in bars]).translate(table)
+            columns.append(np.frombuffer(data, dtype=np.int8))
+        rows.append(_render_channel(np, *columns, samples_per_tick, sample_rate))
+
+    length = max([len(r) for r in rows], default=0)
+    pcm = np.zeros((len(rows), length), dtype=np.float32)
+    for i, r in enumerate(rows):
+        pcm[i, :len(r)] = r
+
+    if separate:
+        return pcm
+    return pcm.sum(axis=0) / max(len(rows), 1)
+
+
+# 16 bit mono wav of render_pcm() samples
+def write_wav(file_path, pcm, sample_rate:int=22050):
+    import numpy as np
+
+    data = (np.clip(pcm, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(file_path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(data.tobytes())
+    return True
+
+
+# MIDI export -----------------------------------------
+# Standard MIDI File (format 1): a tempo track and a track per channel.
+# one tick of a sound is one MIDI tick, a quarter note is 8 ticks, so the
+# tempo is speed/15 sec per quarter. ticks with the same note, tone, volume
+# and effect in a row are one note. the tone is sent as a program change.
+
+MIDI_PPQN = 8
+MIDI_NOTE_OFFSET = 36                   # pyxel note 33 (A, 440Hz) -> MIDI 69
+MIDI_TONE_PROGRAMS = (80, 80, 81, 127)  # T S P N (GM program numbers)
+
+
+def _midi_var_len(val):
+    buf = bytearray([val & 0x7f])
+    val >>= 7
+    while val:
+        buf.insert(0, (val & 0x7f) | 0x80)
+        val >>= 7
+    return bytes(buf)
+
+
+def _midi_channel_events(sl, bars, midi_ch):
+    tables = (_PYXEL_NOTE_TABLE, _PYXEL_TONE_TABLE, _PYXEL_VOLUME_TABLE, _PYXEL_EFFECT_TABLE)
+    var_len = _midi_var_len
+    program = None
+    held = None         # (note, tone, volume, effect) sounding now
+    delta = 0
+
+    for bar in bars:
+        snd = sl[bar]
+        columns = [getattr(snd, name).tobytes().translate(table)
+                   for name, table in zip(("_notes", "_tones", "_volumes", "_effects"), tables)]
+        for tick in zip(*columns):
+            if tick == held:
+                delta += 1
+                continue
+            out = b""
+            if held is not None:
+                out += var_len(delta) + bytes((0x80 | midi_ch, (held[0] + MIDI_NOTE_OFFSET) & 0x7f, 0))
+                delta = 0
+            held = None
+            n = tick[0] if tick[0] < 128 else tick[0] - 256
+            if n >= 0 and tick[2] > 0:
+                if MIDI_TONE_PROGRAMS[tick[1] & 3] != program:
+                    program = MIDI_TONE_PROGRAMS[tick[1] & 3]
+                    out += var_len(delta) + bytes((0xc0 | midi_ch, program))
+                    delta = 0
+                out += var_len(delta) + bytes((0x90 | midi_ch, (n + MIDI_NOTE_OFFSET) & 0x7f, min(tick[2] * 127 // 7, 127)))
+                delta = 0
+                held = (n,) + tick[1:]
+            delta += 1
+            if out:
+                yield out
+    if held is not None:
+        yield var_len(delta) + bytes((0x80 | midi_ch, (held[0] + MIDI_NOTE_OFFSET) & 0x7f, 0))
+        delta = 0
+    yield var_len(delta) + b"\xff\x2f\x00"
+
+
+def _midi_write_track(f, chunks):
+    if f.seekable():
+        # write the events as they come and patch the length afterwards
+        head = f.tell()
+        f.write(b"MTrk\0\0\0\0")
+        size = 0
+        for chunk in chunks:
+            f.write(chunk)
+            size += len(chunk)
+        end = f.tell()
+        f.seek(head + 4)
+        f.write(struct.pack(">I", size))
+        f.seek(end)
+    else:
+        data = b"".join(chunks)
+        f.write(b"MTrk" + struct.pack(">I", len(data)))
+        f.write(data)
+
+
+# bars are played in render_bar_order() order, loop_count=0 ends at the loop end.
+def write_midi(lcmusic, file, loop_count:int=0):
+    if type(lcmusic) is int:
+        lcmusic = lcd[lcmusic]
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as f:
+            return write_midi(lcmusic, f, loop_count)
+
+    bars = render_bar_order(lcmusic, loop_count=loop_count)
+    tempo = int(round(lcmusic.speed * 1000000 / 15))
+
+    file.write(b"MThd" + struct.pack(">IHHH", 6, 1, len(lcmusic.channels) + 1, MIDI_PPQN))
+    _midi_write_track(file, [b"\x00\xff\x51\x03" + tempo.to_bytes(3, "big"), b"\x00\xff\x2f\x00"])
+    for i, sl in enumerate(lcmusic.channels):
+        _midi_write_track(file, _midi_channel_events(sl, bars, i))
+    return True
+
+
+# Batch export ----------------------------------------
+# exports every music of many project files on a process pool.
+# each worker reads a file once (lazily, only the exported musics are decoded)
+# and writes its files itself, so only small ExportResults come back.
+
+@dataclass
+class ExportResult:
+    file_path:str           # project file
+    music_index:int
+    out_path:str = None     # None if the music was skipped or failed
+    seconds:float = 0.0     # time spent on this music in the worker
+    error:str = None
+
+_export_sources = {}        # project file -> LCData, per worker process
+
+
+def _export_wav(lcmusic, out_path, options):
+    pcm = render_pcm(lcmusic, options.get("sample_rate", 22050), loop_count=options.get("loop_count", 1))
+    return write_wav(out_path, pcm, options.get("sample_rate", 22050))
+
+def _export_midi(lcmusic, out_path, options):
+    return write_midi(lcmusic, out_path, options.get("loop_count", 0))
+
+# format -> (extension, function(lcmusic, out_path, options))
+export_formats = {
+    "wav": (".wav", _export_wav),
+    "mid": (".mid", _export_midi),
+}
+
+
+def is_empty_music(lcmusic:LCMusic):
+    for sl in lcmusic.channels:
+        for snd in sl:
+            if snd._notes.count(NONE_VALUE) != len(snd._notes):
+                return False
+    return True
+
+
+def _export_music(file_path, music_index, out_stem, fmt, skip_empty, options):
+    start = time.perf_counter()
+    result = ExportResult(file_path, music_index)
+    try:
+        lcdata = _export_sources.get(file_path)
+        if lcdata is None:
+            doc = read_lcjson(file_path, lazy=True)
+            if doc is None:
+                raise FileNotFoundError(file_path)
+            lcdata = doc["lcdata"]
+            _export_sources.clear()     # jobs are submitted file by file
+            _export_sources[file_path] = lcdata
+
+        lcmusic = lcdata[music_index]
+        if not (skip_empty and is_empty_music(lcmusic)):
+            ext, func = export_formats[fmt]
+            out_path = "%s_%02d%s" % (out_stem, music_index, ext)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            tmp_path = out_path + ".tmp"
+            func(lcmusic, tmp_path, options)
+            os.replace(tmp_path, out_path)
+            result.out_path = out_path
+        lcdata.release_music(music_index)
+    except Exception as e:
+        result.error = "%s: %s" % (type(e).__name__, e)
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+# out_dir/<dir>/<name> of each project file without its extension, <dir> is
+# the directory relative to the common directory of all the files.
+# None if two files would write the same outputs (e.g. a.json and a.txt)
+def _export_stems(file_paths, out_dir):
+    paths = list(dict.fromkeys(os.path.abspath(p) for p in file_paths))
+    if not paths:
+        return {}
+    root = os.path.commonpath([os.path.dirname(p) for p in paths])
+    stems = {}
+    for path in paths:
+        stem = os.path.join(out_dir, os.path.splitext(os.path.relpath(path, root))[0])
+        if stem in stems.values():
+            error("export_library(): " + path + " has the same output name as another file")
+            return None
+        stems[path] = stem
+    return stems
+
+
+# yields an ExportResult per music as soon as it is written (not in order).
+# the files are written to out_dir/<dir>/<name>_<music index>.<ext> (see _export_stems()).
+# max_workers=None uses every core, max_workers=1 exports in this process.
+# options are passed to the format, e.g. sample_rate / loop_count for "wav".
+def export_library(file_paths, out_dir, fmt:str="wav", max_workers:int=None, skip_empty:bool=True, **options):
+    if type(file_paths) is str:
+        file_paths = [file_paths]
+    if fmt not in export_formats:
+        error("export_library(): unknown format " + str(fmt))
+        return
+    stems = _export_stems(file_paths, out_dir)
+    if stems is None:
+        return
+
+    jobs = [(path, i, stem, fmt, skip_empty, options) for path, stem in stems.items() for i in range(MAX_MUSIC_NUM)]
+
+    if max_workers == 1:
+        for job in jobs:
+            result = _export_music(*job)
+            if result.error is not None:
+                error("export_library(): " + result.file_path + " " + str(result.music_index) + " " + result.error)
+            yield result
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_export_music, *job) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            if result.error is not None:
+                error("export_library(): " + result.file_path + " " + str(result.music_index) + " " + result.error)
+            yield result
+
+
 # Misc ------------------------------------------------------------------------
 
 def obj_to_dict(obj):
-    dic = obj.__dict__
+    if isinstance(obj, LCVoice):
+        dic = {"n": obj.n, "t": obj.t, "v": obj.v, "f": obj.f, "id": obj.id}
+    elif isinstance(obj, LCSound):
+        dic = {"vl": obj.vl}
+    elif isinstance(obj, LCData):
+        dic = {k: v for k, v in obj.__dict__.items() if not k.startswith("_")}
+        dic["musics"] = obj[:]
+    else:
+        dic = dict(obj.__dict__)
     class_key = "__" + obj.__class__.__name__ + "__"
     dic[class_key] = True
     return dic
@@ -1507,6 +3706,624 @@ def json_loader_hook(dic):
 
     return dic # 他の型はdefaultのデコード方式を使用
 
+
+# Streaming encoder ---
+# writes the same text as json.dumps(obj, cls=LCJSONEncoder) piece by piece.
+# LCSounds are formatted directly from their arrays and musics of a lazy load
+# that were never decoded are copied from the source file as they are.
+# lcl_format=2 writes every LCSound as four hex columns instead of 32 voice
+# objects, marked with "lcl_format": 2 in the document (Lovely Composer reads 1 only).
+# load() reads both.
+
+LCL_FORMATS = (1, 2)
+
+_JSON_BYTE = ["null" if (b - 256 if b > 127 else b) == NONE_VALUE else str(b - 256 if b > 127 else b) for b in range(256)]
+
+
+def _json_lcsound(snd):
+    table = _JSON_BYTE
+    voices = []
+    for i, (n, t, v, f) in enumerate(zip(snd._notes.tobytes(), snd._tones.tobytes(),
+                                         snd._volumes.tobytes(), snd._effects.tobytes())):
+        id = "null" if snd._ids is None else json.dumps(snd._ids.get(i))
+        voices.append('{"n": ' + table[n] + ', "t": ' + table[t] + ', "v": ' + table[v] + ', "f": ' + table[f]
+                      + ', "id": ' + id + ', "__LCVoice__": true}')
+    return '{"vl": [' + ", ".join(voices) + '], "__LCSound__": true}'
+
+
+def _json_lcsound_v2(snd):
+    s = ('{"notes": "' + snd._notes.tobytes().hex() + '", "tones": "' + snd._tones.tobytes().hex()
+         + '", "volumes": "' + snd._volumes.tobytes().hex() + '", "effects": "' + snd._effects.tobytes().hex() + '"')
+    if snd._ids:
+        s += ', "ids": ' + json.dumps({str(tick): id for tick, id in snd._ids.items()})
+    return s + ', "__LCSound__": true}'
+
+
+def _raw_music_span(lcdata, index, lcl_format):
+    source = lcdata._lazy
+    if lcdata.musics[index] is not None or not isinstance(source, _LazyMusicSource) or not source.has(index):
+        return None
+    if source.lcl_format != lcl_format:
+        return None
+    if _file_stat(source.file_path) != source.stat:
+        return None
+    start, end = source.spans[index]
+    with open(source.file_path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+# spans collects the byte span of every music written
+def _write_json_value(write, obj, spans=None, lcl_format=1):
+    if isinstance(obj, LCSound):
+        write(_json_lcsound(obj) if lcl_format == 1 else _json_lcsound_v2(obj))
+    elif isinstance(obj, LCData):
+        write('{"musics": [')
+        for i in range(len(obj.musics)):
+            if i:
+                write(", ")
+            start = write(None)
+            raw = _raw_music_span(obj, i, lcl_format)
+            if raw is not None:
+                write(raw)
+            else:
+                _write_json_value(write, obj[i], lcl_format=lcl_format)
+            if spans is not None:
+                spans.append((start, write(None)))
+        write("]")
+        for k, v in obj.__dict__.items():
+            if k != "musics" and not k.startswith("_"):
+                write(", " + json.dumps(k) + ": ")
+                _write_json_value(write, v, lcl_format=lcl_format)
+        write(', "__LCData__": true}')
+    elif type(obj) in json_class_list:
+        _write_json_value(write, obj_to_dict(obj), lcl_format=lcl_format)
+    elif type(obj) is dict:
+        write("{")
+        for i, (k, v) in enumerate(obj.items()):
+            write((", " if i else "") + json.dumps(k) + ": ")
+            _write_json_value(write, v, spans, lcl_format)
+        write("}")
+    elif type(obj) in (list, tuple):
+        write("[")
+        for i, v in enumerate(obj):
+            if i:
+                write(", ")
+            _write_json_value(write, v, lcl_format=lcl_format)
+        write("]")
+    else:
+        write(json.dumps(obj, cls=LCJSONEncoder))
+
+
+# write(data) buffers str / bytes, write(None) returns the offset written so far
+def _json_writer(f, text=False, chunk_size=1 << 16):
+    buf = []
+    size = [0, 0]   # buffered, flushed
+
+    def write(data):
+        if data is None:
+            return size[1] + size[0]
+        if text:
+            if type(data) is bytes:
+                data = data.decode("utf-8")
+        elif type(data) is str:
+            data = data.encode("utf-8")
+        buf.append(data)
+        size[0] += len(data)
+        if size[0] >= chunk_size:
+            flush()
+
+    def flush():
+        f.write(("" if text else b"").join(buf))
+        buf.clear()
+        size[1] += size[0]
+        size[0] = 0
+
+    return write, flush
+
+
+# a document is written with its "lcl_format" key set to match
+def _json_document(data, lcl_format):
+    data = {k: v for k, v in data.items() if k != "lcl_format"}
+    if lcl_format != 1:
+        data = {"lcl_format": lcl_format, **data}
+    return data
+
+
+# obj is a LCData, LCMusic, ... or a whole document like lcjson
+def write_json(obj, file=None, lcl_format:int=1):
+    if lcl_format not in LCL_FORMATS:
+        error("write_json(): unknown format " + str(lcl_format))
+        return False
+
+    if file is None:
+        import io
+        with io.BytesIO() as f:
+            write_json(obj, f, lcl_format)
+            return f.getvalue().decode("utf-8")
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as f:
+            return write_json(obj, f, lcl_format)
+
+    if type(obj) is dict and "lcdata" in obj:
+        obj = _json_document(obj, lcl_format)
+    write, flush = _json_writer(file, text=hasattr(file, "encoding"))
+    _write_json_value(write, obj, lcl_format=lcl_format)
+    flush()
+    return True
+
+
+# saves lcjson (or a LCData) to a file. the file is replaced only after the
+# whole document is written, a lazy loaded lcd keeps reading its musics from it.
+def save(lc_json_file_path, data=None, lcl_format:int=1):
+    if lcl_format not in LCL_FORMATS:
+        error("save(): unknown format " + str(lcl_format))
+        return False
+    if data is None:
+        data = lcjson
+    if data is None:
+        error("save(): nothing is loaded")
+        return False
+    if isinstance(data, LCData):
+        data = {"lcdata": data}
+    data = _json_document(data, lcl_format)
+
+    spans = []
+    tmp_path = lc_json_file_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write, flush = _json_writer(f)
+            _write_json_value(write, data, spans, lcl_format)
+            flush()
+        os.replace(tmp_path, lc_json_file_path)
+    except OSError as e:
+        error("save(): " + str(e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+    lcdata = data.get("lcdata")
+    source = lcdata._lazy if isinstance(lcdata, LCData) else None
+    if isinstance(source, _LazyMusicSource) and len(spans) == len(source.spans) and \
+            os.path.abspath(source.file_path) == os.path.abspath(lc_json_file_path):
+        source.spans = [new if old is not None else None for old, new in zip(source.spans, spans)]
+        source.stat = _file_stat(lc_json_file_path)
+        source.lcl_format = lcl_format
+    return True
+
+
+# Schema directed decoder ---
+# json_loader_hook builds a default object for every dict and overwrites it.
+# These decoders know the LCData -> LCMusic -> LCChannelList -> LCSoundList
+# -> LCSound -> LCVoice layout and build each level once from the parsed dicts.
+
+def json_loader(s):
+    return json_decode_value(json.loads(s))
+
+def json_decode_value(val):
+    if type(val) is dict:
+        for key, decoder in json_decoder_dict.items():
+            if key in val:
+                return decoder(val)
+        return {k: json_decode_value(v) for k, v in val.items()}
+    elif type(val) is list:
+        return [json_decode_value(v) for v in val]
+    return val
+
+# Lazy loading ---
+# Only the byte span of every music is located, the rest of the document is
+# decoded as usual. A music is read back from the file and decoded on demand.
+
+_MUSICS_KEY_RE = re.compile(rb'"musics"\s*:\s*\[')
+_WS_RE = re.compile(rb'\s*')
+
+def lazy_json_loader(s, file_path):
+    found = _locate_music_spans(s)
+    if found is None:
+        return json_loader(s)
+
+    head, spans = found
+    doc = json_loader(head)
+    lcdata = doc.get("lcdata") if type(doc) is dict else None
+    if not isinstance(lcdata, LCData) or len(lcdata.musics) != 0:
+        return json_loader(s)
+
+    lcdata.musics = [None] * len(spans)
+    lcdata._lazy = _LazyMusicSource(file_path, spans, doc.get("lcl_format", 1))
+    return doc
+
+def _locate_music_spans(s):
+    m = _MUSICS_KEY_RE.search(s)
+    if m is None:
+        return None
+
+    # every music object ends right after its "__LCMusic__" marker
+    spans = []
+    pos = _WS_RE.match(s, m.end()).end()
+    while s[pos:pos+1] != b"]":
+        if s[pos:pos+1] != b"{":
+            return None
+        marker = s.find(b'"__LCMusic__"', pos)
+        end = s.find(b"}", marker) + 1
+        if marker < 0 or end == 0:
+            return None
+        if s.count(b"{", pos, end) != s.count(b"}", pos, end) or \
+           s.count(b"[", pos, end) != s.count(b"]", pos, end):
+            return None
+        spans.append((pos, end))
+
+        pos = _WS_RE.match(s, end).end()
+        if s[pos:pos+1] == b",":
+            pos = _WS_RE.match(s, pos + 1).end()
+        elif s[pos:pos+1] != b"]":
+            return None
+
+    head = s[:m.end()] + s[pos:]
+    return head, spans
+
+class _LazyMusicSource:
+
+    def __init__(self, file_path, spans, lcl_format=1):
+        self.file_path = file_path
+        self.spans = spans
+        self.stat = _file_stat(file_path)
+        self.lcl_format = lcl_format
+
+    def has(self, index):
+        return self.spans[index] is not None
+
+    def forget(self, index):
+        self.spans[index] = None
+
+    def decode(self, index):
+        if _file_stat(self.file_path) != self.stat:
+            warning("lcl: %s was changed after load, musics are located again", self.file_path)
+            with open(self.file_path, "rb") as f:
+                found = _locate_music_spans(f.read())
+            if found is None or len(found[1]) != len(self.spans):
+                raise ValueError("lcl: can not read music " + str(index) + " from " + self.file_path)
+            self.spans = [new if old is not None else None for old, new in zip(self.spans, found[1])]
+            self.stat = _file_stat(self.file_path)
+
+        start, end = self.spans[index]
+        with open(self.file_path, "rb") as f:
+            f.seek(start)
+            return json_loader(f.read(end - start))
+
+def _file_stat(file_path):
+    st = os.stat(file_path)
+    return (st.st_size, st.st_mtime_ns)
+
+# Binary cache ---
+# <file>.lclcache keeps the fixed size note/tone/volume/effect grids of
+# channels and code_channels plus speed / loop settings of every music.
+# The rest of the document (other keys, rhythms, voice ids, unknown keys) is
+# kept as JSON after the records, so a cache load saves back the same file.
+# It is keyed on the source size, mtime and sha1 and read through mmap,
+# every music is a fixed size record so one music is read without the others.
+# A warm start does not parse the source file, but it still parses this small
+# JSON part (json.loads() in open_cache()).
+
+CACHE_FILE_EXT = ".lclcache"
+CACHE_VERSION = 3
+_CACHE_HEADER = struct.Struct("<4sHHBBBxQq20s")
+_CACHE_MUSIC = struct.Struct("<hhhBx")
+
+def cache_file_path(lc_json_file_path):
+    return lc_json_file_path + CACHE_FILE_EXT
+
+_LCSOUND_STATE = {"_notes", "_tones", "_volumes", "_effects", "_ids", "_version", "_shared"}
+_CACHE_MUSIC_KEYS = ("speed", "loop_start_bar", "loop_end_bar", "enable_loop")   # values in the record
+
+def _is_short(val, low=-0x8000):
+    return type(val) is int and low <= val <= 0x7FFF
+
+# the values of the record of a music, None if they do not fit in it
+def _cache_music_record(music):
+    loops = [getattr(music, k) for k in ("loop_start_bar", "loop_end_bar")]
+    if not _is_short(music.speed) or type(music.enable_loop) is not bool or \
+       not all(v is None or _is_short(v, 0) for v in loops):
+        return None
+    return [music.speed] + [-1 if v is None else v for v in loops] + [music.enable_loop]
+
+# the music without its grids and record values (in key order) and its
+# voice ids, None if the grids hold something the records can not keep
+def _cache_music_extras(music):
+    order = {}
+    for k, v in obj_to_dict(music).items():
+        if not _is_class_key(k):
+            order[k] = None if k in ("channels", "code_channels") + _CACHE_MUSIC_KEYS else v
+    ids = []
+    for i, chs in enumerate((music.channels, music.code_channels)):
+        if set(chs.__dict__) != {"channels"}:
+            return None
+        for ch, sl in enumerate(chs):
+            if set(sl.__dict__) != {"sl"}:
+                return None
+            for bar, snd in enumerate(sl):
+                if not set(snd.__dict__) <= _LCSOUND_STATE:
+                    return None
+                if snd._ids:
+                    ids.append([i, ch, bar, {str(tick): id for tick, id in snd._ids.items()}])
+    return {"music": order, "ids": ids}
+
+def write_cache(lcdata, lc_json_file_path, source=None, doc=None):
+    if source is None:
+        with open(lc_json_file_path, "rb") as f:
+            source = f.read()
+
+    musics = lcdata[:]
+    ch_num = len(musics[0].channels) if musics else pyxel.MUSIC_CHANNEL_COUNT
+    extras = []
+    for m in musics:
+        for chs in (m.channels, m.code_channels):
+            if len(chs) != ch_num or any(len(sl) != MAX_BAR_LENGTH for sl in chs) or \
+               any(len(snd) != MAX_SOUND_LENGTH for sl in chs for snd in sl):
+                debug("lcl.write_cache(): irregular music size, cache is not written")
+                return False
+        extras.append(_cache_music_extras(m))
+        if extras[-1] is None or _cache_music_record(m) is None:
+            debug("lcl.write_cache(): irregular music data, cache is not written")
+            return False
+
+    # the document with an empty lcdata
+    head = LCData.__new__(LCData)
+    head.__dict__.update({k: v for k, v in lcdata.__dict__.items() if not k.startswith("_")})
+    head.musics = []
+    doc = dict(doc) if doc is not None else {}
+    doc["lcdata"] = head
+    tail = write_json({"head": doc, "musics": extras}).encode("utf-8")
+
+    size, mtime_ns = _file_stat(lc_json_file_path)
+    header = _CACHE_HEADER.pack(b"LCLC", CACHE_VERSION, len(musics), ch_num, MAX_BAR_LENGTH,
+                                MAX_SOUND_LENGTH, size, mtime_ns, hashlib.sha1(source).digest())
+    cache_path = cache_file_path(lc_json_file_path)
+    try:
+        with open(cache_path + ".tmp", "wb") as f:
+            f.write(header)
+            for m in musics:
+                f.write(_CACHE_MUSIC.pack(*_cache_music_record(m)))
+                for chs in (m.channels, m.code_channels):
+                    for sl in chs:
+                        for snd in sl:
+                            f.write(snd._notes.tobytes() + snd._tones.tobytes() +
+                                    snd._volumes.tobytes() + snd._effects.tobytes())
+            f.write(tail)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError as e:
+        warning("lcl.write_cache(): %s", e)
+        return False
+    return True
+
+def open_cache(lc_json_file_path, source=None):
+    cache_path = cache_file_path(lc_json_file_path)
+    if not os.path.isfile(cache_path):
+        return None
+
+    with open(cache_path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return None
+
+    if len(mm) < _CACHE_HEADER.size:
+        mm.close()
+        return None
+    magic, version, music_num, ch_num, bar_num, snd_len, size, mtime_ns, digest = _CACHE_HEADER.unpack_from(mm)
+    record_size = _CACHE_MUSIC.size + 2 * ch_num * bar_num * snd_len * 4
+    end = _CACHE_HEADER.size + music_num * record_size
+    if magic != b"LCLC" or version != CACHE_VERSION or len(mm) <= end or \
+       not _is_cache_valid(lc_json_file_path, size, mtime_ns, digest, source):
+        mm.close()
+        return None
+
+    try:
+        tail = json.loads(mm[end:])
+    except ValueError:
+        mm.close()
+        return None
+    return _CacheMusicSource(mm, music_num, ch_num, bar_num, snd_len, record_size, tail)
+
+def _is_cache_valid(lc_json_file_path, size, mtime_ns, digest, source):
+    if _file_stat(lc_json_file_path) == (size, mtime_ns):
+        return True
+    if os.path.getsize(lc_json_file_path) != size:
+        return False
+    if source is None:
+        with open(lc_json_file_path, "rb") as f:
+            source = f.read()
+    return hashlib.sha1(source).digest() == digest
+
+class _CacheMusicSource:
+
+    def __init__(self, mm, music_num, ch_num, bar_num, snd_len, record_size, tail):
+        self.mm = mm
+        self.music_num = music_num
+        self.ch_num = ch_num
+        self.bar_num = bar_num
+        self.snd_len = snd_len
+        self.record_size = record_size
+        self.head = tail["head"]
+        self.extras = tail["musics"]
+        self.forgotten = set()
+
+    def to_doc(self, lazy):
+        doc = json_decode_value(self.head)
+        lcdata = doc["lcdata"]
+        lcdata.musics = [None] * self.music_num
+        lcdata._lazy = self
+        if not lazy:
+            lcdata._decode_all()
+            self.mm.close()
+        return doc
+
+    def has(self, index):
+        return index not in self.forgotten
+
+    def forget(self, index):
+        self.forgotten.add(index)
+
+    def decode(self, index):
+        pos = _CACHE_HEADER.size + index * self.record_size
+        speed, loop_start_bar, loop_end_bar, enable_loop = _CACHE_MUSIC.unpack_from(self.mm, pos)
+        record = {"speed": speed,
+                  "loop_start_bar": None if loop_start_bar < 0 else loop_start_bar,
+                  "loop_end_bar": None if loop_end_bar < 0 else loop_end_bar,
+                  "enable_loop": bool(enable_loop)}
+        pos += _CACHE_MUSIC.size
+
+        music = LCMusic.__new__(LCMusic)
+        channels, pos = self._decode_channels(pos)
+        code_channels, pos = self._decode_channels(pos)
+
+        # the keys are set in the order of the file
+        extras = self.extras[index]
+        for k, v in json_decode_value(extras["music"]).items():
+            if k == "channels":
+                v = channels
+            elif k == "code_channels":
+                v = code_channels
+            elif k in record:
+                v = record[k]
+            setattr(music, k, v)
+        for i, ch, bar, ids in extras["ids"]:
+            snd = (music.channels, music.code_channels)[i][ch][bar]
+            snd._ids = {int(tick): id for tick, id in ids.items()}
+        return music
+
+    def _decode_channels(self, pos):
+        mm = self.mm
+        n = self.snd_len
+        chs = LCChannelList.__new__(LCChannelList)
+        chs.channels = []
+        for ch in range(self.ch_num):
+            sl = LCSoundList.__new__(LCSoundList)
+            sl.sl = []
+            for bar in range(self.bar_num):
+                snd = LCSound.__new__(LCSound)
+                snd._notes = array("b", mm[pos:pos+n])
+                snd._tones = array("b", mm[pos+n:pos+2*n])
+                snd._volumes = array("b", mm[pos+2*n:pos+3*n])
+                snd._effects = array("b", mm[pos+3*n:pos+4*n])
+                snd._ids = None
+                snd._touch()
+                sl.sl.append(snd)
+                pos += 4 * n
+            chs.channels.append(sl)
+        return chs, pos
+
+def _is_class_key(key):
+    return key.startswith("__") and key.endswith("__")
+
+def _decode_attrs(obj, dic, field_decoders):
+    for k, v in dic.items():
+        decoder = field_decoders.get(k)
+        if decoder is not None:
+            setattr(obj, k, decoder(v))
+        elif not _is_class_key(k):
+            setattr(obj, k, json_decode_value(v))
+    return obj
+
+def _decode_as(class_key, decoder):
+    # decode with the schema when the dict carries the expected marker
+    def decode(val):
+        if type(val) is dict and class_key in val:
+            return decoder(val)
+        return json_decode_value(val)
+    return decode
+
+def _decode_list_of(decoder):
+    def decode(val):
+        if type(val) is list:
+            return [decoder(v) for v in val]
+        return json_decode_value(val)
+    return decode
+
+def _decode_lcdata(dic):
+    obj = _decode_attrs(LCData.__new__(LCData), dic, _lcdata_fields)
+    if "musics" not in dic:
+        obj.musics = [LCMusic() for i in range(MAX_MUSIC_NUM)]
+    return obj
+
+def _decode_lcmusic(dic):
+    obj = _decode_attrs(LCMusic.__new__(LCMusic), dic, _lcmusic_fields)
+    if "channels" not in dic:
+        obj.channels = LCChannelList()
+    if "code_channels" not in dic:
+        obj.code_channels = LCChannelList()
+    if "rhythms" not in dic:
+        obj.rhythms = LCRhythmList()
+    return obj
+
+def _decode_lcchannellist(dic):
+    obj = _decode_attrs(LCChannelList.__new__(LCChannelList), dic, _lcchannellist_fields)
+    if "channels" not in dic:
+        obj.channels = [LCSoundList() for i in range(pyxel.MUSIC_CHANNEL_COUNT)]
+    return obj
+
+def _decode_lcsoundlist(dic):
+    obj = _decode_attrs(LCSoundList.__new__(LCSoundList), dic, _lcsoundlist_fields)
+    if "sl" not in dic:
+        obj.sl = [LCSound() for i in range(16)]
+    return obj
+
+def _decode_lcsound(dic):
+    obj = LCSound.__new__(LCSound)
+    obj.set_size(MAX_SOUND_LENGTH)
+    for k, v in dic.items():
+        if k == "vl":
+            _decode_voices(obj, v)
+        elif k in _LCSOUND_COLUMNS:
+            setattr(obj, _LCSOUND_COLUMNS[k], array("b", bytes.fromhex(v)))
+        elif k == "ids":
+            obj._ids = {int(tick): id for tick, id in v.items()} or None
+        elif not _is_class_key(k):
+            setattr(obj, k, json_decode_value(v))
+    return obj
+
+# v2 columns: hex of the signed bytes of each array
+_LCSOUND_COLUMNS = {"notes": "_notes", "tones": "_tones", "volumes": "_volumes", "effects": "_effects"}
+
+def _decode_voices(obj, vl):
+    # pack the voice dicts column by column
+    try:
+        obj._notes = array("b", [NONE_VALUE if n is None else n for n in [d.get("n") for d in vl]])
+        obj._tones = array("b", [NONE_VALUE if t is None else t for t in [d.get("t", 0) for d in vl]])
+        obj._volumes = array("b", [NONE_VALUE if v is None else v for v in [d.get("v", 5) for d in vl]])
+        obj._effects = array("b", [NONE_VALUE if f is None else f for f in [d.get("f", 0) for d in vl]])
+        ids = [d.get("id") for d in vl]
+    except (AttributeError, TypeError, OverflowError):
+        # unusual voices (e.g. note names as strings) take the generic path
+        obj.vl = [json_decode_value(d) if type(d) is not dict else _decode_lcvoice(d) for d in vl]
+        return
+    obj._ids = None
+    if ids.count(None) != len(ids):
+        obj._set_id_list(ids)
+
+def _decode_lcvoice(dic):
+    obj = LCVoice()
+    for k, v in dic.items():
+        if not _is_class_key(k):
+            setattr(obj, k, json_decode_value(v))
+    obj.__post_init__()
+    return obj
+
+def _decode_lcrhythmlist(dic):
+    obj = _decode_attrs(LCRhythmList.__new__(LCRhythmList), dic, {})
+    if "rhythms" not in dic:
+        obj.rhythms = []
+    return obj
+
+def _decode_lcrhythm(dic):
+    obj = _decode_attrs(LCRhythm.__new__(LCRhythm), dic, {})
+    if "codes" not in dic:
+        obj.codes = []
+    return obj
+
+def _decode_appsettings(dic):
+    return _decode_attrs(AppSettings.__new__(AppSettings), dic, {})
+
 # module variables ---
 
 json_class_list = [
@@ -1525,3 +4342,24 @@ json_class_dict ={}
 for c in json_class_list:
     json_class_dict["__" + c.__name__ + "__"] = c
 #debug(json_class_dict)
+
+_lcsoundlist_fields = {"sl": _decode_list_of(_decode_as("__LCSound__", _decode_lcsound))}
+_lcchannellist_fields = {"channels": _decode_list_of(_decode_as("__LCSoundList__", _decode_lcsoundlist))}
+_lcmusic_fields = {
+    "channels": _decode_as("__LCChannelList__", _decode_lcchannellist),
+    "code_channels": _decode_as("__LCChannelList__", _decode_lcchannellist),
+    "rhythms": _decode_as("__LCRhythmList__", _decode_lcrhythmlist),
+}
+_lcdata_fields = {"musics": _decode_list_of(_decode_as("__LCMusic__", _decode_lcmusic))}
+
+json_decoder_dict = {
+    "__LCData__": _decode_lcdata,
+    "__LCMusic__": _decode_lcmusic,
+    "__LCChannelList__": _decode_lcchannellist,
+    "__LCSoundList__": _decode_lcsoundlist,
+    "__LCSound__": _decode_lcsound,
+    "__LCVoice__": _decode_lcvoice,
+    "__LCRhythmList__": _decode_lcrhythmlist,
+    "__LCRhythm__": _decode_lcrhythm,
+    "__AppSettings__": _decode_appsettings,
+}
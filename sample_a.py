@@ -2,7 +2,7 @@ import pyxel
 import lcl
 
 def update():
-    pass
+    lcl.update()   # loops loop region musics, call it every frame
 
 def draw():
     pass
@@ -0,0 +1,908 @@
+import os
+import sys
+import io
+import json
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import lcl
+
+
+MUSIC_NUM = 4
+
+# a small project in the format Lovely Composer writes (LCJSONEncoder),
+# the musics after MUSIC_NUM are left empty
+def make_project_text(seed=0, music_num=MUSIC_NUM):
+    rnd = random.Random(seed)
+    lcd = lcl.LCData()
+    lcd.musics = lcd.musics[:music_num]
+    for i, m in enumerate(lcd.musics[:MUSIC_NUM]):
+        m.speed = 10 + i * 5
+        if i % 2 == 0:
+            m.loop_start_bar = 1
+            m.loop_end_bar = 6
+        for chs in (m.channels, m.code_channels):
+            for sl in chs:
+                for snd in sl:
+                    for v in snd:
+                        if rnd.random() < 0.6:
+                            v.n = rnd.randrange(60)
+                            v.t = rnd.randrange(4)
+                            v.v = rnd.randrange(8)
+                            v.f = rnd.randrange(4)
+    lcd.musics[0].channels[0][0][3].id = 7
+    lcd.musics[1].code_channels[2][5][0].id = 2
+    doc = {"lcdata": lcd, "app_settings": lcl.AppSettings(), "version": "1.0"}
+    return json.dumps(doc, cls=lcl.LCJSONEncoder)
+
+
+class HeadlessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        lcl.use_backend("headless")
+        self.dir = tempfile.mkdtemp()
+        self.text = make_project_text()
+        self.path = os.path.join(self.dir, "project.json")
+        with open(self.path, "w") as f:
+            f.write(self.text)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+def bank_values(snd_idx):
+    snd = lcl.sound(snd_idx)
+    return [list(snd.note), list(snd.tone), list(snd.volume), list(snd.effect)]
+
+
+# number of sounds set to the bank while func runs
+def count_uploads(func, *args, **kwargs):
+    with mock.patch.object(lcl.ExSound, "set_by_lcsound", autospec=True,
+                           side_effect=lcl.ExSound.set_by_lcsound) as set_by_lcsound:
+        func(*args, **kwargs)
+    return set_by_lcsound.call_count
+
+
+def wait_preloads():
+    for p in list(lcl.preloads.values()):
+        p.done.wait(10)
+
+
+class LCSoundTest(unittest.TestCase):
+
+    def test_voice_view_writes_the_arrays(self):
+        snd = lcl.LCSound()
+        snd[2].n = 30
+        snd[2].set_by_str("C2:S7F")
+        self.assertEqual(snd.notes[2], lcl.get_note_num("C2"))
+        self.assertEqual((snd.tones[2], snd.volumes[2], snd.effects[2]), (1, 7, 3))
+        self.assertIsNone(snd.notes[0])
+
+    def test_copied_voice_is_detached(self):
+        snd = lcl.LCSound()
+        v = snd[0].__copy__()
+        v.n = 12
+        self.assertIsNone(snd[0].n)
+        snd[1] = v
+        self.assertEqual(snd[1].n, 12)
+
+    def test_edit_changes_version(self):
+        snd = lcl.LCSound()
+        version = snd.version
+        snd[0].v = 3
+        self.assertNotEqual(snd.version, version)
+
+
+class JsonDecodeTest(HeadlessTestCase):
+
+    def test_v1_round_trip(self):
+        self.assertTrue(lcl.load(self.path))
+        self.assertEqual(lcl.write_json(lcl.lcjson), self.text)
+        self.assertEqual(lcl.lcd[0].channels[0][0][3].id, 7)
+
+    def test_same_result_as_the_object_hook(self):
+        doc = json.loads(self.text, object_hook=lcl.json_loader_hook)
+        self.assertEqual(lcl.write_json(lcl.json_loader(self.text.encode("utf-8"))), lcl.write_json(doc))
+
+
+class LazyLoadTest(HeadlessTestCase):
+
+    def test_lazy_load(self):
+        lcl.load(self.path, lazy=True)
+        self.assertFalse(lcl.lcd.is_decoded(1))
+        self.assertEqual(lcl.write_json(lcl.lcjson), self.text)
+        self.assertFalse(lcl.lcd.is_decoded(1))
+        self.assertEqual(lcl.lcd[1].code_channels[2][5][0].id, 2)
+
+    def test_release_unused_keeps_edited_musics(self):
+        lcl.load(self.path, lazy=True, release_unused=True)
+        lcl.play(1)
+        lcl.lcd[1].channels[0][0][0].n = 3
+        lcl.lcd[3].speed = 77
+        lcl.play(2)
+        lcl.sound_bank.clear()
+        lcl.play(0)
+        self.assertFalse(lcl.lcd.is_decoded(2))
+        self.assertEqual(lcl.lcd[1].channels[0][0][0].n, 3)
+        self.assertEqual(lcl.lcd[3].speed, 77)
+
+
+class CacheTest(HeadlessTestCase):
+
+    def test_cache_load(self):
+        lcl.load(self.path, cache=True)
+        self.assertTrue(os.path.isfile(lcl.cache_file_path(self.path)))
+        for lazy in (False, True):
+            lcl.load(self.path, lazy=lazy, cache=True)
+            if lazy:
+                self.assertIsInstance(lcl.lcd._lazy, lcl._CacheMusicSource)
+            self.assertEqual(lcl.write_json(lcl.lcjson), self.text)
+
+    def test_cache_record_values(self):
+        lcl.load(self.path, cache=True)
+        source = lcl.open_cache(self.path)
+        self.assertIsNone(source.extras[2]["music"]["speed"])
+        music = source.decode(2)
+        self.assertEqual((music.speed, music.loop_start_bar, music.loop_end_bar), (20, 1, 6))
+        self.assertIsNone(source.decode(1).loop_end_bar)
+        source.mm.close()
+
+    def test_changed_file_is_read_again(self):
+        lcl.load(self.path, cache=True)
+        text = make_project_text(seed=1)
+        with open(self.path, "w") as f:
+            f.write(text)
+        self.assertIsNone(lcl.open_cache(self.path))
+        lcl.load(self.path, cache=True)
+        self.assertEqual(lcl.write_json(lcl.lcjson), text)
+
+
+class UploadTest(HeadlessTestCase):
+
+    def test_sounds_hold_the_values_of_the_bars(self):
+        lcl.load(self.path)
+        lcl.load_lcmusic(1, dedupe=False)
+        music = lcl.lcd[1]
+        for ch in range(4):
+            for bar in (0, 7, 15):
+                snd_idx = lcl.get_target_sound_id(ch, bar)
+                self.assertEqual(bank_values(snd_idx), list(music.channels[ch][bar].pyxel_values()))
+                self.assertEqual(lcl.sound(snd_idx).speed, music.speed)
+
+    def test_empty_voice_values(self):
+        snd = lcl.LCSound()
+        snd[1].n = 12
+        snd[1].v = -1
+        notes, tones, volumes, effects = snd.pyxel_values()
+        self.assertEqual((notes[0], notes[1]), (-1, 12))
+        self.assertEqual(volumes[1], 5)
+
+
+class DirtyBarTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+
+    def test_dirty_bar_upload_count(self):
+        lcl.load_lcmusic(0, dedupe=False)
+        update = lambda: lcl.update_note_mixing(base=lcl.loaded_sound_base, layout=None)
+        self.assertEqual(update(), 0)
+        lcl.lcm.channels[2][5][0].n = 11
+        self.assertEqual(lcl.lcm.dirty_cells(), [(2, 5)])
+        self.assertEqual(update(), 1)
+        snd_idx = lcl.get_target_sound_id(2, 5)
+        self.assertEqual(lcl.sound(snd_idx).note[0], 11)
+        self.assertEqual(update(), 0)
+
+    def test_speed_change_sets_every_sound(self):
+        lcl.load_lcmusic(0, dedupe=False)
+        lcl.lcm.speed += 1
+        self.assertEqual(len(lcl.lcm.dirty_cells()), 64)
+
+
+class SeekTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+
+    def test_seek_sets_no_sound(self):
+        lcl.play(1, start_bar=2)
+        self.assertEqual(count_uploads(lcl.seek, 5), 0)
+        self.assertEqual(lcl.music(7).ch0[0], lcl.get_target_sound_id(0, 5))
+        self.assertEqual(lcl.pyxel.calls[-1], ("playm", 7, False))
+
+    def test_replay_starts_at_the_start_bar(self):
+        lcl.play(1, start_bar=2, loop=True)
+        lcl.seek(9)
+        self.assertEqual(count_uploads(lcl.replay), 0)
+        self.assertEqual(lcl.music(7).ch0[0], lcl.get_target_sound_id(0, 2))
+        self.assertEqual(lcl.pyxel.calls[-1], ("playm", 7, True))
+
+    def test_seek_errors(self):
+        self.assertFalse(lcl.seek(0))
+        lcl.play(1)
+        self.assertFalse(lcl.seek(16))
+
+
+class LoopTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+
+    def ch0_table(self, start, end):
+        return [lcl.get_target_sound_id(0, bar) for bar in range(start, end)]
+
+    def test_loop_region_switch(self):
+        lcl.play(0, loop=True)     # loop region 1 - 6
+        ch0 = lcl.music(7).ch0
+        self.assertEqual(ch0, self.ch0_table(0, 7) + self.ch0_table(1, 7) * lcl.LOOP_PASSES)
+        lcl.update()
+        self.assertEqual(lcl.music(7).ch0, ch0)
+
+        lcl.pyxel.play_positions[0] = 7 * 100 + 3
+        lcl.update()
+        self.assertEqual(lcl.music(7).ch0, self.ch0_table(1, 7))
+        self.assertEqual(lcl.pyxel.calls[-1], ("playm", 7, True))
+        self.assertIsNone(lcl.music_loop_switch)
+
+    def test_late_update_keeps_the_bar(self):
+        lcl.play(0, loop=True)
+        lcl.pyxel.play_positions[0] = 9 * 100
+        lcl.update()
+        self.assertEqual(lcl.music(7).ch0, self.ch0_table(3, 7) + self.ch0_table(1, 3))
+
+    def test_no_switch_without_loop(self):
+        lcl.play(0, loop=False)
+        self.assertIsNone(lcl.music_loop_switch)
+        self.assertEqual(lcl.pyxel.calls[-1], ("playm", 7, False))
+
+
+class StreamTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+
+    def assertRing(self, page, lcmusic, bar):
+        stream = lcl.music_stream
+        for ch in range(4):
+            self.assertEqual(bank_values(stream.sound_index(ch, page)),
+                             list(lcmusic.channels[ch][bar].pyxel_values()))
+
+    def test_ring_is_fed_by_update(self):
+        self.assertTrue(lcl.play_stream(1, ring_pages=4))
+        stream = lcl.music_stream
+        self.assertEqual(lcl.music(7).ch0, [stream.sound_index(0, page) for page in range(4)])
+        self.assertEqual(lcl.sound_bank.get(("stream", 7)).count, 16)
+        for page in range(4):
+            self.assertRing(page, lcl.lcd[1], page)
+
+        lcl.pyxel.play_positions[0] = 2 * 100
+        lcl.update()
+        self.assertEqual(stream.step, 2)
+        self.assertRing(0, lcl.lcd[1], 4)
+        self.assertRing(1, lcl.lcd[1], 5)
+        self.assertRing(2, lcl.lcd[1], 2)
+
+    def test_loop_region_in_the_ring(self):
+        lcl.play_stream(0, start_bar=5, ring_pages=4)
+        self.assertRing(2, lcl.lcd[0], 1)       # 5 6 | 1 2
+
+    def test_stream_ends(self):
+        lcl.play_stream(1, start_bar=14, ring_pages=2)
+        lcl.pyxel.play_positions[0] = 100
+        lcl.update()
+        lcl.pyxel.play_positions[0] = 0
+        lcl.update()
+        self.assertIsNone(lcl.music_stream)
+        self.assertEqual(lcl.pyxel.calls[-1][0], "stop")
+
+    def test_play_stream_clears_the_loaded_music(self):
+        lcl.play(1)
+        lcl.play_stream(2)
+        self.assertIsNone(lcl.loaded_lcmusic_index)
+        self.assertFalse(lcl.seek(0))
+
+
+class SoundBankTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bank = lcl.SoundBank(0, 12)
+
+    def test_lru_eviction(self):
+        a, resident = self.bank.alloc("a", 4)
+        self.assertFalse(resident)
+        self.bank.alloc("b", 4)
+        self.bank.alloc("c", 4)
+        self.assertTrue(self.bank.alloc("a", 4)[1])     # touched
+        self.bank.alloc("d", 4)
+        self.assertIsNone(self.bank.get("b"))
+        self.assertIs(self.bank.get("a"), a)
+        self.assertEqual(self.bank.get("d").base, 4)
+
+    def test_keep_pin_and_spare(self):
+        self.bank.alloc("a", 4)
+        self.bank.alloc("b", 4, pin=True)
+        self.bank.alloc("c", 4)
+        self.assertIsNone(self.bank.alloc("d", 8, keep=["a", "c"])[0])
+        self.assertEqual(list(self.bank.entries), ["a", "b", "c"])
+        self.bank.alloc("d", 4, spare=["a"])
+        self.assertIsNone(self.bank.get("c"))
+        self.assertIsNotNone(self.bank.get("a"))
+
+    def test_new_size_or_owner_is_a_new_block(self):
+        owner = object()
+        self.bank.alloc("a", 4, owner=owner)
+        self.assertTrue(self.bank.alloc("a", 4, owner=owner)[1])
+        self.assertFalse(self.bank.alloc("a", 4)[1])
+        self.assertFalse(self.bank.alloc("a", 5)[1])
+
+    def test_reserve(self):
+        self.bank.alloc("a", 4, from_tail=False)
+        self.bank.alloc("b", 4, from_tail=False)
+        self.bank.reserve(2, 3)
+        self.assertIsNone(self.bank.get("a"))
+        self.assertIsNotNone(self.bank.get("b"))
+        self.assertNotIn(2, self.bank.sound_indices(self.bank.alloc("c", 3, from_tail=False)[0].key))
+
+    def test_musics_stay_resident(self):
+        lcl.load(self.path)
+        lcl.play(0, load_pages=4, dedupe=False)
+        lcl.play(1, load_pages=4, dedupe=False)
+        self.assertEqual(count_uploads(lcl.play, 0, load_pages=4, dedupe=False), 0)
+
+
+class DedupeTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+        self.music = lcl.lcd[0]
+        for ch in range(4):
+            for bar in range(8, 16):
+                self.music.channels[ch][bar].clear()
+
+    def test_identical_bars_share_a_sound(self):
+        lcl.play(0)
+        self.assertEqual(lcl.get_target_sound_id(0, 8), lcl.get_target_sound_id(3, 15))
+        self.assertNotEqual(lcl.get_target_sound_id(0, 0), lcl.get_target_sound_id(0, 8))
+
+    def test_edit_in_an_empty_bar_sets_one_sound(self):
+        lcl.play(0)
+        count = lcl.sound_bank.get(lcl.loaded_sound_key).count
+        self.music.channels[1][10][3].n = 20
+        self.assertEqual(count_uploads(lcl.play, 0), 1)
+        self.assertEqual(lcl.sound(lcl.get_target_sound_id(1, 10)).note[3], 20)
+        self.assertEqual(lcl.sound_bank.get(lcl.loaded_sound_key).count, count)
+        self.music.channels[1][10][3].n = None
+        self.assertEqual(count_uploads(lcl.play, 0), 0)
+        self.assertEqual(lcl.get_target_sound_id(1, 10), lcl.get_target_sound_id(0, 8))
+
+    def test_block_grows_when_it_is_full(self):
+        lcl.play(0)
+        for bar in range(8, 8 + lcl.DEDUPE_SPARE_SOUNDS + 1):
+            self.music.channels[2][bar][0].n = bar
+        lcl.play(0)
+        for bar in range(8, 8 + lcl.DEDUPE_SPARE_SOUNDS + 1):
+            self.assertEqual(lcl.sound(lcl.get_target_sound_id(2, bar)).note[0], bar)
+
+
+class PreloadTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path, lazy=True)
+
+    def test_preloaded_music_is_resident(self):
+        lcl.play(0, load_pages=8)
+        self.assertTrue(lcl.preload(1, load_pages=8))
+        self.assertTrue(lcl.is_preloading())
+        wait_preloads()
+        lcl.update()
+        self.assertFalse(lcl.is_preloading())
+        self.assertEqual(count_uploads(lcl.play, 1, load_pages=8), 0)
+        self.assertEqual(bank_values(lcl.get_target_sound_id(3, 7)),
+                         list(lcl.lcd[1].channels[3][7].pyxel_values()))
+
+    def test_preload_never_evicts_the_playing_music(self):
+        lcl.play(0, dedupe=False)
+        key = lcl.loaded_sound_key
+        lcl.preload(1, dedupe=False)
+        wait_preloads()
+        lcl.update()
+        self.assertIsNotNone(lcl.sound_bank.get(key))
+
+    def test_load_lcmusic_finishes_the_preload(self):
+        lcl.preload(2)
+        lcl.load_lcmusic(2)
+        self.assertFalse(lcl.is_preloading())
+        self.assertEqual(lcl.loaded_lcmusic_index, 2)
+
+
+class QueueTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+
+    def test_switch_at_the_next_bar(self):
+        lcl.play(0, loop=True)
+        self.assertTrue(lcl.queue(1))
+        wait_preloads()
+        lcl.update()
+        self.assertEqual(lcl.loaded_lcmusic_index, 0)
+        lcl.pyxel.play_positions[0] = 100
+        lcl.update()
+        self.assertEqual(lcl.loaded_lcmusic_index, 1)
+        self.assertIsNone(lcl.music_queue)
+        self.assertEqual(lcl.music(7).ch0[0], lcl.get_target_sound_id(0, 0))
+        self.assertEqual(lcl.pyxel.calls[-1], ("playm", 7, False))
+        self.assertNotIn(("stop", -1), lcl.pyxel.calls[-2:])
+
+    def test_switch_at_the_loop_end(self):
+        lcl.play(0, loop=True)     # loop region 1 - 6
+        lcl.queue(1, at="loop_end")
+        wait_preloads()
+        for bar in (1, 5, 6):
+            lcl.pyxel.play_positions[0] = bar * 100
+            lcl.update()
+            self.assertEqual(lcl.loaded_lcmusic_index, 0)
+        lcl.pyxel.play_positions[0] = 700
+        lcl.update()
+        self.assertEqual(lcl.loaded_lcmusic_index, 1)
+
+    def test_nothing_playing_plays_at_once(self):
+        lcl.queue(2)
+        self.assertEqual(lcl.loaded_lcmusic_index, 2)
+        self.assertIsNone(lcl.music_queue)
+
+    def test_stream_switch_is_written_to_the_ring(self):
+        lcl.play_stream(0, ring_pages=4)
+        lcl.queue(1)
+        stream = lcl.music_stream
+        for ch in range(4):
+            self.assertEqual(bank_values(stream.sound_index(ch, 1)),
+                             list(lcl.lcd[1].channels[ch][0].pyxel_values()))
+            self.assertEqual(bank_values(stream.sound_index(ch, 3)),
+                             list(lcl.lcd[1].channels[ch][2].pyxel_values()))
+
+
+class LoadJobTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path, lazy=True)
+
+    def run_job(self, job):
+        while not job.step(0):
+            pass
+
+    def test_finished_job_is_resident(self):
+        job = lcl.begin_load(2)
+        job.step(0)
+        self.assertLess(job.progress, 1.0)
+        self.run_job(job)
+        self.assertTrue(job.result)
+        self.assertEqual(job.progress, 1.0)
+        self.assertEqual(count_uploads(lcl.play, 2), 0)
+
+    def test_job_block_is_kept_when_there_is_room(self):
+        lcl.load(self.path)
+        job = lcl.begin_load(2, load_pages=4, dedupe=False)
+        for i in range(8):
+            job.step(0)
+        self.assertTrue(lcl.play(0, load_pages=4, dedupe=False))
+        self.run_job(job)
+        self.assertTrue(job.result)
+        self.assertIsNotNone(lcl.sound_bank.get(job.key))
+        self.assertEqual(lcl.load_jobs, [])
+
+    def test_play_during_job_does_not_get_overwritten(self):
+        job = lcl.begin_load(2, dedupe=False)
+        for i in range(30):
+            job.step(0)
+        lcl.play(0, dedupe=False)
+        values = [bank_values(i) for i in lcl.sound_bank.sound_indices(lcl.loaded_sound_key)]
+        self.run_job(job)
+        self.assertFalse(job.result)
+        self.assertEqual([bank_values(i) for i in lcl.sound_bank.sound_indices(lcl.loaded_sound_key)], values)
+
+    def test_cancel(self):
+        job = lcl.begin_load(1)
+        job.step(0)
+        job.cancel()
+        self.assertTrue(job.done)
+        self.assertFalse(job.result)
+        self.assertEqual(lcl.load_jobs, [])
+
+
+class SfxTest(HeadlessTestCase):
+
+    def test_registered_sfx_has_its_own_sound(self):
+        self.assertTrue(lcl.register_sfx("jump", "C3E3G3:S7N:10"))
+        snd_idx = lcl.sfx_table["jump"]
+        self.assertEqual(list(lcl.sound(snd_idx).note), [36, 40, 43])
+        self.assertEqual(lcl.sound(snd_idx).speed, 10)
+        self.assertTrue(lcl.sfx("jump", ch=3))
+        self.assertEqual(lcl.pyxel.calls[-1], ("play", 3, snd_idx, False))
+        self.assertFalse(lcl.sfx("walk"))
+
+    def test_sfx_never_evicts_music(self):
+        lcl.load(self.path)
+        lcl.play(0, dedupe=False)
+        key = lcl.loaded_sound_key
+        lcl.register_sfx("jump", "C3E3:S7N")
+        self.assertNotIn("jump", lcl.sfx_table)
+        self.assertIsNotNone(lcl.sound_bank.get(key))
+        self.assertTrue(lcl.sfx("jump", ch=3))
+        self.assertEqual(lcl.pyxel.calls[-1], ("play", 3, lcl.pyxel.SOUND_BANK_FOR_SYSTEM, False))
+
+    def test_reserved_sfx_slots(self):
+        lcl.load(self.path)
+        lcl.reserve_sfx(0, 2)
+        lcl.register_sfx("a", "C3:S7N")
+        lcl.register_sfx("b", "D3:S7N")
+        self.assertEqual(sorted(lcl.sfx_table.values()), [0, 1])
+        lcl.play(0, load_pages=15, dedupe=False)
+        self.assertEqual(list(lcl.sound(lcl.sfx_table["b"]).note), [38])
+
+
+class ChannelPoolTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.pool = lcl.ChannelPool(channels=[2, 3])
+
+    def test_free_channels_first(self):
+        self.assertEqual(self.pool.play(1, priority=1), 3)
+        self.assertEqual(self.pool.play(2, priority=1), 2)
+        self.assertIsNone(self.pool.play(3, priority=0))
+
+    def test_steals_the_lowest_priority(self):
+        self.pool.play(1, priority=2, length=5.0)
+        self.pool.play(2, priority=1, length=5.0)
+        self.assertEqual(self.pool.play(3, priority=1), 2)
+        self.assertEqual(lcl.pyxel.calls[-1], ("play", 2, 3, False))
+
+    def test_steals_the_one_closest_to_its_end(self):
+        self.pool.play(1, priority=1, length=5.0)
+        self.pool.play(2, priority=1, length=0.1)
+        self.assertEqual(self.pool.play(3, priority=1), 2)
+
+    def test_music_channels(self):
+        lcl.pyxel.play(2, 0)
+        lcl.pyxel.play(3, 0)
+        self.pool.music_started([2, 3])
+        self.assertIsNone(self.pool.play(1, priority=50))
+        self.assertEqual(self.pool.play(1, priority=101), 3)
+
+
+class HeadlessBackendTest(unittest.TestCase):
+
+    def test_sound_and_music_banks(self):
+        backend = lcl.use_backend("headless")
+        self.assertIs(lcl.pyxel, backend)
+        snd = lcl.sound(5)
+        self.assertIsInstance(snd, backend.Sound)
+        snd.set_values([1, 2], [0, 1], [7, 6], [0, 3], speed=12)
+        self.assertEqual(bank_values(5), [[1, 2], [0, 1], [7, 6], [0, 3]])
+        self.assertEqual(lcl.sound(5).speed, 12)
+        backend.sound(6).set("c3 e-3 r", "ts", "7", "n", 20)
+        self.assertEqual(list(backend.sound(6).note), [36, 39, -1])
+
+        lcl.music(1).set([5], [], [], [6])
+        backend.playm(1)
+        self.assertEqual((backend.play_pos(0), backend.play_pos(1), backend.play_pos(3)), (0, -1, 0))
+        backend.stop()
+        self.assertEqual(backend.play_pos(0), -1)
+        self.assertEqual(backend.calls, [("playm", 1, False), ("stop", -1)])
+
+    def test_backend_switch_resets_the_state(self):
+        lcl.use_backend("headless")
+        lcl.sound_bank.alloc("a", 4)
+        lcl.register_sfx("jump", "C3:S7N")
+        lcl.use_backend("headless")
+        self.assertEqual(lcl.sound_bank.entries, {})
+        self.assertEqual(lcl.sfx_table, {})
+        self.assertIsNone(lcl.loaded_sound_table)
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class RenderTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+
+    def test_length_and_channels(self):
+        music = lcl.lcd[1]
+        pcm = lcl.render_pcm(music, sample_rate=8000, separate=True)
+        ticks = 16 * 32
+        self.assertEqual(pcm.shape, (4, int(round(ticks * music.speed * 8000 / 120))))
+        self.assertEqual(pcm.dtype, numpy.float32)
+        self.assertTrue(numpy.all(numpy.abs(pcm) <= 1.0))
+        mixed = lcl.render_pcm(music, sample_rate=8000)
+        self.assertTrue(numpy.allclose(mixed, pcm.sum(axis=0) / 4))
+
+    def test_bar_order(self):
+        music = lcl.lcd[0]     # loop region 1 - 6
+        self.assertEqual(lcl.render_bar_order(music, start_bar=5, loop_count=2), [5, 6] + [1, 2, 3, 4, 5, 6] * 2)
+        self.assertEqual(lcl.render_bar_order(lcl.lcd[1], start_bar=14), [14, 15])
+
+    def test_rests_are_silent(self):
+        music = lcl.LCMusic()
+        music.channels[0][0][0].set_by_str("A3:T7N")
+        pcm = lcl.render_pcm(music, sample_rate=8000, pages=1, separate=True)
+        samples_per_tick = int(music.speed * 8000 / 120)
+        self.assertGreater(numpy.abs(pcm[0, :samples_per_tick]).max(), 0.5)
+        self.assertEqual(numpy.abs(pcm[0, samples_per_tick:]).max(), 0.0)
+        self.assertEqual(numpy.abs(pcm[1:]).max(), 0.0)
+
+    def test_write_wav(self):
+        import wave
+        path = os.path.join(self.dir, "a.wav")
+        pcm = lcl.render_pcm(lcl.lcd[1], sample_rate=8000)
+        lcl.write_wav(path, pcm, 8000)
+        with wave.open(path) as w:
+            self.assertEqual((w.getframerate(), w.getnframes(), w.getsampwidth()), (8000, len(pcm), 2))
+
+
+class ExportTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        text = make_project_text(music_num=lcl.MAX_MUSIC_NUM)
+        self.paths = []
+        for name in ("a", "b"):
+            os.makedirs(os.path.join(self.dir, "songs", name))
+            path = os.path.join(self.dir, "songs", name, "project.json")
+            with open(path, "w") as f:
+                f.write(text)
+            self.paths.append(path)
+        self.out_dir = os.path.join(self.dir, "out")
+
+    def exported(self, results):
+        return sorted(os.path.relpath(r.out_path, self.out_dir) for r in results if r.out_path is not None)
+
+    def test_every_file_has_its_own_outputs(self):
+        results = list(lcl.export_library(self.paths, self.out_dir, fmt="mid", max_workers=1))
+        self.assertEqual(len(results), 2 * lcl.MAX_MUSIC_NUM)
+        self.assertEqual([r.error for r in results if r.error], [])
+        names = ["project_%02d.mid" % i for i in range(MUSIC_NUM)]
+        self.assertEqual(self.exported(results), [os.path.join(d, n) for d in "ab" for n in names])
+
+    def test_process_pool(self):
+        results = list(lcl.export_library(self.paths, self.out_dir, fmt="mid", max_workers=2))
+        self.assertEqual(len(self.exported(results)), 2 * MUSIC_NUM)
+        with open(os.path.join(self.out_dir, "b", "project_01.mid"), "rb") as f:
+            data = f.read()
+        lcl.load(self.paths[1])
+        out = io.BytesIO()
+        lcl.write_midi(lcl.lcd[1], out)
+        self.assertEqual(data, out.getvalue())
+
+    def test_name_collision(self):
+        other = os.path.join(self.dir, "songs", "a", "project.txt")
+        shutil.copy(self.paths[0], other)
+        results = list(lcl.export_library([self.paths[0], other], self.out_dir, fmt="mid", max_workers=1))
+        self.assertEqual(results, [])
+        self.assertFalse(os.path.exists(self.out_dir))
+
+
+class MidiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.music = lcl.LCMusic()
+        self.music.speed = 30
+        for tick in (0, 1):
+            self.music.channels[0][0][tick].set_voice(lcl.LCVoice(33, 0, 7, 0))
+
+    def tracks(self, data):
+        self.assertEqual(data[:4], b"MThd")
+        self.assertEqual(struct.unpack(">IHHH", data[4:14]), (6, 1, 5, lcl.MIDI_PPQN))
+        pos = 14
+        tracks = []
+        while pos < len(data):
+            self.assertEqual(data[pos:pos + 4], b"MTrk")
+            size, = struct.unpack(">I", data[pos + 4:pos + 8])
+            tracks.append(data[pos + 8:pos + 8 + size])
+            pos += 8 + size
+        return tracks
+
+    def test_byte_layout(self):
+        f = io.BytesIO()
+        self.assertTrue(self.music.to_midi(f))
+        tracks = self.tracks(f.getvalue())
+        self.assertEqual(len(tracks), 5)
+        # 30 * 1000000 / 15 = 0x1e8480 usec per quarter note
+        self.assertEqual(tracks[0], b"\x00\xff\x51\x03\x1e\x84\x80\x00\xff\x2f\x00")
+        # program 80, note 69 on for 2 ticks, end of track at tick 16 * 32
+        self.assertEqual(tracks[1], b"\x00\xc0\x50\x00\x90\x45\x7f\x02\x80\x45\x00\x83\x7e\xff\x2f\x00")
+        self.assertEqual(tracks[2], b"\x84\x00\xff\x2f\x00")
+
+    def test_new_note_on_a_change(self):
+        self.music.channels[0][0][1].set_voice(lcl.LCVoice(33, 2, 3, 0))
+        track = self.tracks(self.write())[1]
+        self.assertEqual(track[:16], b"\x00\xc0\x50\x00\x90\x45\x7f\x01\x80\x45\x00\x00\xc0\x51\x00\x90")
+
+    def write(self):
+        f = io.BytesIO()
+        lcl.write_midi(self.music, f)
+        return f.getvalue()
+
+    def test_unseekable_file(self):
+        class Pipe(io.RawIOBase):
+            def __init__(self):
+                self.data = b""
+            def writable(self):
+                return True
+            def write(self, b):
+                self.data += bytes(b)
+                return len(b)
+        pipe = Pipe()
+        lcl.write_midi(self.music, pipe)
+        self.assertEqual(pipe.data, self.write())
+
+    def test_var_len(self):
+        self.assertEqual(lcl._midi_var_len(0), b"\x00")
+        self.assertEqual(lcl._midi_var_len(0x7f), b"\x7f")
+        self.assertEqual(lcl._midi_var_len(0x80), b"\x81\x00")
+        self.assertEqual(lcl._midi_var_len(0x3fff), b"\xff\x7f")
+
+
+class SaveTest(HeadlessTestCase):
+
+    def test_encoder_does_not_mutate(self):
+        lcl.load(self.path)
+        m = lcl.lcd[0]
+        json.dumps(m, cls=lcl.LCJSONEncoder)
+        self.assertNotIn("__LCMusic__", m.__dict__)
+
+    def test_save_writes_the_same_text(self):
+        lcl.load(self.path)
+        path = os.path.join(self.dir, "saved.json")
+        self.assertTrue(lcl.save(path))
+        with open(path) as f:
+            self.assertEqual(f.read(), self.text)
+        f = io.StringIO()
+        lcl.lcd[0].to_json(f)
+        self.assertEqual(f.getvalue(), json.dumps(lcl.lcd[0], cls=lcl.LCJSONEncoder))
+
+    def test_lazy_save_in_place(self):
+        lcl.load(self.path, lazy=True)
+        lcl.lcd[2].speed = 99
+        self.assertTrue(lcl.save(self.path))
+        self.assertFalse(lcl.lcd.is_decoded(3))
+        expected = lcl.write_json(lcl.lcjson)
+        lcl.load(self.path)
+        self.assertEqual(lcl.lcd[2].speed, 99)
+        self.assertEqual(lcl.write_json(lcl.lcjson), expected)
+
+
+class V2FormatTest(HeadlessTestCase):
+
+    def test_v2_load(self):
+        lcl.load(self.path)
+        v2_path = os.path.join(self.dir, "v2.json")
+        self.assertTrue(lcl.save(v2_path, lcl_format=2))
+        self.assertLess(os.path.getsize(v2_path), len(self.text))
+        for lazy in (False, True):
+            lcl.load(v2_path, lazy=lazy)
+            self.assertEqual(lcl.lcjson["lcl_format"], 2)
+            self.assertEqual(lcl.write_json(lcl.lcjson), self.text)
+
+    def test_unknown_format(self):
+        lcl.load(self.path)
+        self.assertFalse(lcl.save(os.path.join(self.dir, "v3.json"), lcl_format=3))
+
+
+class SnapshotTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+        self.music = lcl.lcd[0]
+
+    def test_snapshot_isolation(self):
+        m = self.music
+        snap = m.snapshot()
+        text = lcl.write_json(snap)
+        m.channels[0][1][0].n = 5
+        m.channels[3][3].set_note_to_all(None)
+        self.assertEqual(lcl.write_json(snap), text)
+        snap.channels[0][2][0].n = 6
+        self.assertNotEqual(m.channels[0][2][0].n, 6)
+        self.assertIs(m.channels[1][0]._notes, snap.channels[1][0]._notes)
+
+    def test_update_music_keeps_a_snapshot(self):
+        m = self.music
+        lcl.lcd.update_music(3, m)
+        text = lcl.write_json(lcl.lcd[3])
+        m.channels[0][0][0].n = 1
+        self.assertEqual(lcl.write_json(lcl.lcd[3]), text)
+
+
+class RangeClipboardTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+        self.music = lcl.lcd[0]
+
+    def test_copy_range_matches_copy_notes(self):
+        m = self.music
+        clip = m.copy_range(2, 20, 4, 5, channels=[0, 2], low=10, high=40)
+        for row, ids, ch in zip(clip.rows, clip.ids, clip.channels):
+            voices = m.copy_notes(ch, 2, 20, 31, low=10, high=40) + \
+                     m.copy_notes(ch, 3, 0, 31, low=10, high=40) + \
+                     m.copy_notes(ch, 4, 0, 5, low=10, high=40)
+            self.assertEqual(clip.length, len(voices))
+            got = [(lcl._unpack(n - 256 if n > 127 else n), t, v, f)
+                   for n, t, v, f in zip(*row)]
+            self.assertEqual(got, [(v.n, v.t, v.v, v.f) for v in voices])
+
+    def test_cut_and_paste_range(self):
+        m = self.music
+        before = m.snapshot()
+        clip = m.cut_range(0, 0, 1, 31, channels=[1])
+        self.assertTrue(all(v.is_clear() for v in m.channels[1][0]))
+        m.paste_range(clip, 0, 0)
+        self.assertEqual(lcl.write_json(m), lcl.write_json(before))
+
+    def test_paste_to_other_channels(self):
+        m = self.music
+        clip = m.copy_range(0, 0, 0, 31, channels=[0])
+        before = m.channels[3][6][16].n
+        m.paste_range(clip, 5, 16, channels=[3])
+        self.assertEqual(m.channels[3][5][16:] + m.channels[3][6][:16], m.channels[0][0][:])
+        self.assertEqual(m.channels[3][6][16].n, before)
+
+
+class TransformTest(HeadlessTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lcl.load(self.path)
+        self.music = lcl.lcd[0]
+
+    def test_transform_keeps_empty_volume(self):
+        m = self.music
+        m.channels[0][0][0].v = -1
+        m.transform(transpose=1)
+        self.assertEqual(m.channels[0][0][0].v, -1)
+
+    def test_transpose_and_volume(self):
+        m = self.music
+        before = m.snapshot()
+        self.assertGreater(m.transform(channels=[1], transpose=2, volume_add=-1), 0)
+        for old, new in zip(before.channels[1][4], m.channels[1][4]):
+            if old.n is None:
+                self.assertIsNone(new.n)
+            else:
+                self.assertEqual(new.n, min(old.n + 2, lcl.MAX_NOTE))
+                self.assertEqual(new.v, max(old.v - 1, 0))
+        self.assertEqual(lcl.write_json(m.channels[0]), lcl.write_json(before.channels[0]))
+
+    def test_identity_changes_nothing(self):
+        version = self.music.channels[0][0].version
+        self.assertEqual(self.music.transform(), 0)
+        self.assertEqual(self.music.channels[0][0].version, version)
+
+
+if __name__ == "__main__":
+    unittest.main()